@@ -1,22 +1,28 @@
 import sys
 
-import qdarkstyle
 from PyQt5.QtWidgets import QApplication
 
 from gui.controller import Controller
-from gui.gui import UiMainWindow
 
 
 class ScreenRecorder(QApplication):
     def __init__(self, argv):
         super(ScreenRecorder, self).__init__(argv)
-        verbose = True if len(argv) > 1 and argv[1] else False
-        self.view = UiMainWindow(verbose)
-        self.controller = Controller(self.view, verbose)
+        self.setQuitOnLastWindowClosed(False)  # The app keeps running in the tray
+        self.verbose = True if len(argv) > 1 and argv[1] else False
+        self.controller = Controller(self.make_view, self.verbose)
         self.tray = self.controller.create_tray()
         self.tray.start()
 
+    def make_view(self):
+        """
+        Options window - the GUI modules and the style sheet are only loaded when it's first opened
+        """
+        import qdarkstyle
+        from gui.gui import UiMainWindow
+
         self.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
+        return UiMainWindow(self.verbose)
 
     def exec(self) -> int:
         out = super().exec()
@@ -1,21 +1,27 @@
 import sys
 
-import qdarkstyle
 from PyQt5.QtWidgets import QApplication
 
 from gui.controller import Controller
-from gui.gui import UiMainWindow
 
 
 class ScreenRecorder(QApplication):
     def __init__(self, argv):
         super(ScreenRecorder, self).__init__(argv)
-        self.view = UiMainWindow()
-        self.controller = Controller(self.view)
+        self.setQuitOnLastWindowClosed(False)  # The app keeps running in the tray
+        self.controller = Controller(self.make_view)
         self.tray = self.controller.create_tray()
         self.tray.start()
 
+    def make_view(self):
+        """
+        Options window - the GUI modules and the style sheet are only loaded when it's first opened
+        """
+        import qdarkstyle
+        from gui.gui import UiMainWindow
+
         self.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
+        return UiMainWindow()
 
     def exec(self) -> int:
         out = super().exec()
@@ -0,0 +1,67 @@
+"""
+Headless benchmark of the capture pipeline, e.g.
+
+    python -m instant_replay.benchmark --source static scroll noise --size 1920x1080 --output results.json
+"""
+import argparse
+import json
+import sys
+
+import instant_replay.values as values
+from instant_replay.benchmark.pipeline import run_benchmark
+from instant_replay.benchmark.sources import SOURCES
+from instant_replay.capture.capture import VID_ENCODERS, parse_resolution
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m instant_replay.benchmark",
+                                     description="Measure the convert, buffer and export stages with synthetic frames")
+    parser.add_argument("--source", nargs="+", choices=sorted(SOURCES), default=["scroll"])
+    parser.add_argument("--size", nargs="+", default=["1920x1080"], help="generated frame sizes, WIDTHxHEIGHT")
+    parser.add_argument("--resolution", default="native", help="downscale frames to fit, WIDTHxHEIGHT")
+    parser.add_argument("--fps", type=int, default=values.DEFAULT_FPS)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--quality", type=int, default=values.DEFAULT_QUALITY)
+    parser.add_argument("--transport", choices=values.ALL_CONFIG_VALUES['transport'], default=values.DEFAULT_TRANSPORT)
+    parser.add_argument("--encoders", type=int, default=values.DEFAULT_ENCODERS)
+    # The segments mode bypasses the frame buffer this benchmark measures
+    parser.add_argument("--buffer-mode", choices=[mode for mode in values.ALL_CONFIG_VALUES['buffer_mode']
+                                                  if mode != values.BUFFER_SEGMENTS],
+                        default=values.DEFAULT_BUFFER_MODE)
+    parser.add_argument("--ram-usage", type=int, default=values.DEFAULT_RAM_USAGE // values.MB, help="MB")
+    parser.add_argument("--codec", nargs="+", choices=sorted(VID_ENCODERS), help="all available if not given")
+    parser.add_argument("--output", help="JSON file for the results, printed if not given")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    results = []
+    for size in args.size:
+        for source in args.source:
+            if args.verbose:
+                print(f"[Benchmark] {source} {size}...")
+            results.append(run_benchmark(source=source,
+                                         size=parse_resolution(size),
+                                         fps=args.fps,
+                                         seconds=args.seconds,
+                                         quality=args.quality,
+                                         resolution=parse_resolution(args.resolution),
+                                         transport=args.transport,
+                                         encoders=args.encoders,
+                                         buffer_mode=args.buffer_mode,
+                                         ram_usage=args.ram_usage * values.MB,
+                                         codecs=args.codec,
+                                         verbose=args.verbose))
+
+    if args.output is None:
+        print(json.dumps(results, indent=4))
+    else:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+import queue
+import tempfile
+import time
+from multiprocessing import Queue
+
+import numpy as np
+
+import instant_replay.values as values
+from instant_replay.benchmark.sources import SOURCES
+from instant_replay.capture.buffer import FrameBuffer, RawFrameSlots, TransportStats
+from instant_replay.capture.capture import ConvertProcess, FileSaver, Frame, VID_ENCODERS, scaled_size
+from instant_replay.capture.pacing import FramePacer
+from instant_replay.capture.sources import RawFrame
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss(who=None):
+    """
+    :param who: resource.RUSAGE_SELF or RUSAGE_CHILDREN (largest of the terminated children)
+    :return: peak resident set size in bytes, None where it can't be measured
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who is None else who)
+    return usage.ru_maxrss * 1024  # Kilobytes on Linux
+
+
+def percentiles(samples_ns):
+    """
+    :return: dict with latency percentiles in milliseconds
+    """
+    if not samples_ns:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None}
+    p50, p95, p99, top = np.percentile(np.asarray(samples_ns) / pow(10, 6), (50, 95, 99, 100))
+    return {'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'max_ms': top}
+
+
+class TimedConvertProcess(ConvertProcess):
+    """
+    ConvertProcess recording how long every frame took from capture until it was published in the buffer
+    """
+
+    def __init__(self, *args, results: Queue, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.results = results
+        self.latencies = []
+
+    def _store(self, item, kind, data, encode_ns=None, skipped=False):
+        super()._store(item, kind, data, encode_ns, skipped)
+        self.latencies.append(time.perf_counter_ns() - item[1])
+
+    def run(self):
+        super().run()
+        self.results.put({
+            'latencies': self.latencies,
+            'peak_rss': peak_rss(),
+            'encoder_peak_rss': peak_rss(resource.RUSAGE_CHILDREN) if resource is not None else None,
+            'quality': self.current_quality,
+            'frame_step': self.frame_step,
+        })
+
+
+def _feed(source, n_frames, fps, img_queue, raw_slots, stats):
+    """
+    Play the part of the recorder: hand the synthetic frames over at the target frame rate
+    :return: (grab times in ns, pacer statistics)
+    """
+    pacer = FramePacer(pow(10, 9) / fps)
+    grab_times = []
+    for i in range(n_frames):
+        timestamp = pacer.wait()
+        frame = source.frame(i)
+        if raw_slots is None:
+            try:
+                img_queue.put_nowait((RawFrame(frame.tobytes(), source.size), timestamp))
+            except queue.Full:
+                stats.increment(TransportStats.DROPPED)
+                continue
+        else:
+            slot = raw_slots.acquire()
+            if slot is None:
+                stats.increment(TransportStats.DROPPED)
+                continue
+            raw_slots.write(slot, frame.reshape(-1).data)
+            img_queue.put((slot, timestamp, source.size))
+        stats.increment(TransportStats.GRABBED)
+        grab_times.append(time.perf_counter_ns() - timestamp)
+    img_queue.put(None)
+    return grab_times, pacer.stats()
+
+
+def _export(buffer, codec, fps, frame_size, directory):
+    """
+    Export the whole buffer with one of the video encoders
+    :return: dict with the export wall time and the file size
+    """
+    encoder = VID_ENCODERS[codec](fps, FileSaver(directory, "bench", VID_ENCODERS[codec].extension))
+    pin, first, end = buffer.snapshot()
+    try:
+        frames = (Frame(data, values.CAPTURE_JPEG, frame_size, kind, timestamp)
+                  for kind, data, timestamp in buffer.iter_frames(first, end))
+        start = time.perf_counter_ns()
+        path = encoder.encode(frames, frame_size)
+        wall = time.perf_counter_ns() - start
+    finally:
+        buffer.release(pin)
+    with open(path, "rb") as file:
+        file.seek(0, 2)
+        file_size = file.tell()
+    return {'frames': end - first, 'wall_s': wall / pow(10, 9), 'file_bytes': file_size}
+
+
+def run_benchmark(source="scroll",
+                  size=values.DEFAULT_SCREEN_SIZE,
+                  fps=values.DEFAULT_FPS,
+                  seconds=10,
+                  quality=values.DEFAULT_QUALITY,
+                  resolution=None,
+                  transport=values.DEFAULT_TRANSPORT,
+                  encoders=values.DEFAULT_ENCODERS,
+                  buffer_mode=values.DEFAULT_BUFFER_MODE,
+                  ram_usage=values.DEFAULT_RAM_USAGE,
+                  codecs=None,
+                  verbose=False):
+    """
+    Push `seconds` worth of synthetic frames through the converter and the frame buffer, then export the
+    buffer with every video encoder.
+    :param source: name of a synthetic source from SOURCES
+    :param size: (width, height) of the generated frames
+    :param resolution: (width, height) the frames are downscaled to fit, None - keep `size`
+    :param codecs: keys of VID_ENCODERS to export with, None - all available on this system
+    :return: dict with the settings and the measurements, ready to be dumped as JSON
+    """
+    frame_source = SOURCES[source](size)
+    if codecs is None:
+        codecs = [codec for codec, encoder in VID_ENCODERS.items() if encoder.available()]
+    n_frames = int(seconds * fps)
+    n_slots = values.RAW_SLOTS + (encoders or values.MAX_ENCODERS)
+
+    buffer = FrameBuffer.from_config(seconds, fps, ram_usage)
+    stats = TransportStats()
+    img_queue = Queue(maxsize=n_slots)
+    raw_slots = None
+    if transport == values.TRANSPORT_SHM:
+        raw_slots = RawFrameSlots(n_slots, size[0] * size[1] * 4, Queue())
+    results = Queue()
+    converter = TimedConvertProcess(img_queue, buffer, seconds, fps, values.CAPTURE_JPEG, quality, stats, raw_slots,
+                                    resolution, encoders, buffer_mode, verbose=verbose, results=results)
+
+    try:
+        converter.start()
+        start = time.perf_counter_ns()
+        grab_times, pacing = _feed(frame_source, n_frames, fps, img_queue, raw_slots, stats)
+        converted = results.get()
+        converter.join()
+        elapsed = (time.perf_counter_ns() - start) / pow(10, 9)
+
+        used, buffered = buffer.used_bytes()
+        frame_size = scaled_size(size, resolution)
+        with tempfile.TemporaryDirectory() as directory:
+            exports = {codec: _export(buffer, codec, fps, frame_size, directory) for codec in codecs}
+    finally:
+        buffer.unlink()
+        if raw_slots is not None:
+            raw_slots.unlink()
+
+    transport_stats = stats.get()
+    return {
+        'settings': {
+            'source': source,
+            'size': list(size),
+            'resolution': list(frame_size),
+            'fps': fps,
+            'seconds': seconds,
+            'quality': quality,
+            'transport': transport,
+            'encoders': encoders,
+            'buffer_mode': buffer_mode,
+            'ram_usage': ram_usage,
+        },
+        'frames': {
+            'generated': n_frames,
+            'grabbed': transport_stats['grabbed'],
+            'dropped': transport_stats['dropped'],
+            'converted': len(converted['latencies']),
+            'buffered': buffered,
+        },
+        'sustained_fps': len(converted['latencies']) / elapsed,
+        'pacing': pacing,
+        'latency': {
+            'grab': percentiles(grab_times),
+            'capture_to_buffer': percentiles(converted['latencies']),
+        },
+        'buffer': {
+            'used_bytes': used,
+            'bytes_per_frame': used / buffered if buffered else None,
+            'final_quality': converted['quality'],
+            'final_frame_step': converted['frame_step'],
+        },
+        'peak_rss': {
+            'main': peak_rss(),
+            'converter': converted['peak_rss'],
+            'encoders': converted['encoder_peak_rss'],
+        },
+        'export': exports,
+    }
@@ -0,0 +1,91 @@
+from abc import abstractmethod
+
+import cv2
+import numpy as np
+
+_NOISE_FRAMES = 8  # Random frames are generated up front and cycled, generating them live is slower than encoding
+
+
+class SyntheticSource:
+    """
+    Produces raw BGRA frames without a display, so the pipeline can be measured on headless machines
+    """
+    name = None
+
+    def __init__(self,
+                 size):
+        self.size = size  # (width, height)
+
+    @abstractmethod
+    def frame(self, i):
+        """
+        :param i: frame number
+        :return: C-contiguous numpy array of shape (height, width, 4)
+        """
+        pass
+
+
+class StaticSource(SyntheticSource):
+    """
+    The same picture every frame - best case for delta frames
+    """
+    name = "static"
+
+    def __init__(self,
+                 size):
+        super().__init__(size)
+        width, height = size
+        x = np.linspace(0, 255, width, dtype=np.uint8)
+        y = np.linspace(0, 255, height, dtype=np.uint8)
+        self.image = np.empty((height, width, 4), dtype=np.uint8)
+        self.image[..., 0] = x[np.newaxis, :]
+        self.image[..., 1] = y[:, np.newaxis]
+        self.image[..., 2] = 128
+        self.image[..., 3] = 255
+
+    def frame(self, i):
+        return self.image
+
+
+class ScrollingTextSource(SyntheticSource):
+    """
+    Lines of text moving up, like a terminal or a scrolled document
+    """
+    name = "scroll"
+
+    def __init__(self,
+                 size,
+                 speed=4):
+        super().__init__(size)
+        width, height = size
+        self.speed = speed  # Pixels per frame
+        self.canvas = np.full((2 * height, width, 4), 255, dtype=np.uint8)
+        for line, y in enumerate(range(24, 2 * height, 24)):
+            text = f"{line:05d} The quick brown fox jumps over the lazy dog " * 4
+            cv2.putText(self.canvas, text, (8, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0, 255), 1, cv2.LINE_AA)
+
+    def frame(self, i):
+        height = self.size[1]
+        offset = i * self.speed % height
+        return np.ascontiguousarray(self.canvas[offset:offset + height])
+
+
+class NoiseSource(SyntheticSource):
+    """
+    Every pixel changes every frame - worst case for both JPEG and delta frames
+    """
+    name = "noise"
+
+    def __init__(self,
+                 size,
+                 seed=0):
+        super().__init__(size)
+        width, height = size
+        rng = np.random.default_rng(seed)
+        self.frames = [rng.integers(0, 256, (height, width, 4), dtype=np.uint8) for _ in range(_NOISE_FRAMES)]
+
+    def frame(self, i):
+        return self.frames[i % len(self.frames)]
+
+
+SOURCES = {source.name: source for source in (StaticSource, ScrollingTextSource, NoiseSource)}
@@ -0,0 +1,101 @@
+"""
+Cold start cost of the app, every target is measured in a fresh interpreter, e.g.
+
+    python -m instant_replay.benchmark.startup --repeat 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Libraries that should only be loaded once they are needed
+HEAVY_MODULES = ("PyQt5.QtWidgets", "qdarkstyle", "cv2", "numpy", "PIL.Image", "mss")
+
+TARGETS = {
+    'capture': "import instant_replay.capture.capture",
+    'controller': "import instant_replay.gui.controller",
+    'gui': "import instant_replay.gui.gui",
+    # Tray-only launch up to the first event loop iteration, with the user's config
+    'launch': "from PyQt5.QtCore import QTimer\n"
+              "from instant_replay.app import ScreenRecorder\n"
+              "app = ScreenRecorder([''])\n"
+              "QTimer.singleShot(0, app.controller.close_app)\n"
+              "app.exec()",
+}
+
+# Runs in the child: the target, then its wall time and the heavy modules it loaded as the last line
+_HARNESS = """
+import sys, time, json
+start = time.perf_counter()
+exec(compile({code!r}, "<target>", "exec"))
+elapsed = time.perf_counter() - start
+loaded = [name for name in {heavy!r} if name in sys.modules and type(sys.modules[name]).__name__ != "_LazyModule"]
+print(json.dumps({{'wall_ms': elapsed * 1000, 'loaded': loaded}}))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    :param stderr: output of `python -X importtime`
+    :return: dict module -> cumulative import time in ms
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def measure(code, repeat=1, top=10):
+    """
+    Run `code` in `repeat` fresh interpreters
+    :return: dict with the median wall time, the heavy modules loaded with their import times and the
+             slowest imports, or the error if the target couldn't run
+    """
+    walls = []
+    result = None
+    for _ in range(repeat):
+        harness = _HARNESS.format(code=code, heavy=HEAVY_MODULES)
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", harness], capture_output=True, text=True,
+                                 cwd=os.getcwd())
+        if process.returncode != 0:
+            return {'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "failed"}
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        walls.append(result['wall_ms'])
+    imports = parse_importtime(process.stderr)
+    slowest = sorted(((ms, name) for name, ms in imports.items() if not name.startswith("instant_replay")),
+                     reverse=True)[:top]
+    return {
+        'wall_ms': statistics.median(walls),
+        'heavy_loaded': {name: imports.get(name) for name in result['loaded']},
+        'slowest_imports_ms': {name: ms for ms, name in slowest},
+    }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m instant_replay.benchmark.startup",
+                                     description="Measure the import and start-up time of the app")
+    parser.add_argument("--target", nargs="+", choices=sorted(TARGETS), default=sorted(TARGETS))
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per target, the median is kept")
+    parser.add_argument("--top", type=int, default=10, help="number of the slowest imports to list")
+    parser.add_argument("--output", help="JSON file for the results, printed if not given")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    results = {target: measure(TARGETS[target], args.repeat, args.top) for target in args.target}
+    if args.output is None:
+        print(json.dumps(results, indent=4))
+    else:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import struct
+
+_AVIF_HASINDEX = 0x10
+_AVIIF_KEYFRAME = 0x10
+_FRAME_CHUNK = b"00dc"
+
+
+class AviWriter:
+    """
+    Minimal AVI 1.0 (RIFF) muxer for a single MJPEG video stream. Encoded JPEG frames are written as they are,
+    without decoding. Header fields that depend on the number of frames are patched in `close`.
+    AVI 1.0 uses 32-bit sizes, so files are limited to 4 GB (some players stop at 2 GB).
+    """
+
+    def __init__(self,
+                 path,
+                 fps,
+                 size):
+        self.path = path
+        self.fps = fps
+        self.width, self.height = size
+
+        self._file = open(path, "wb")
+        self._index = []  # (offset relative to the 'movi' fourcc, size)
+        self._max_frame = 0
+        self._write_headers()
+
+    def _write_headers(self):
+        scale, rate = 1000, round(self.fps * 1000)
+        write = self._file.write
+
+        write(b"RIFF" + struct.pack("<I", 0) + b"AVI ")
+        write(b"LIST" + struct.pack("<I", 4 + 64 + 12 + 64 + 48) + b"hdrl")
+
+        self._avih_pos = self._file.tell()
+        write(b"avih" + struct.pack("<I", 56))
+        write(struct.pack("<10I4I",
+                          round(1_000_000 / self.fps),  # Microseconds per frame
+                          0,  # Max bytes per second
+                          0,  # Padding granularity
+                          _AVIF_HASINDEX,
+                          0,  # Total frames, patched later
+                          0,  # Initial frames
+                          1,  # Streams
+                          0,  # Suggested buffer size, patched later
+                          self.width,
+                          self.height,
+                          0, 0, 0, 0))
+
+        write(b"LIST" + struct.pack("<I", 4 + 64 + 48) + b"strl")
+        self._strh_pos = self._file.tell()
+        write(b"strh" + struct.pack("<I", 56))
+        write(b"vids" + b"MJPG" + struct.pack("<IHHIIIIIIiI4h",
+                                              0,  # Flags
+                                              0,  # Priority
+                                              0,  # Language
+                                              0,  # Initial frames
+                                              scale,
+                                              rate,
+                                              0,  # Start
+                                              0,  # Length, patched later
+                                              0,  # Suggested buffer size, patched later
+                                              -1,  # Quality
+                                              0,  # Sample size
+                                              0, 0, self.width, self.height))
+        write(b"strf" + struct.pack("<I", 40))
+        write(struct.pack("<IiiHH4sIiiII",
+                          40,
+                          self.width,
+                          self.height,
+                          1,  # Planes
+                          24,  # Bit count
+                          b"MJPG",
+                          self.width * self.height * 3,
+                          0, 0, 0, 0))
+
+        self._movi_pos = self._file.tell()
+        write(b"LIST" + struct.pack("<I", 0) + b"movi")
+
+    def write(self, jpeg):
+        """
+        :param jpeg: bytes-like object with a complete JPEG image
+        """
+        size = len(jpeg)
+        self._index.append((self._file.tell() - (self._movi_pos + 8), size))
+        self._file.write(_FRAME_CHUNK + struct.pack("<I", size))
+        self._file.write(jpeg)
+        if size % 2:
+            self._file.write(b"\0")
+        self._max_frame = max(self._max_frame, size)
+
+    def close(self):
+        write = self._file.write
+        movi_end = self._file.tell()
+
+        write(b"idx1" + struct.pack("<I", 16 * len(self._index)))
+        write(b"".join(_FRAME_CHUNK + struct.pack("<III", _AVIIF_KEYFRAME, offset, size)
+                       for offset, size in self._index))
+        file_end = self._file.tell()
+
+        def patch(pos, fmt, *values):
+            self._file.seek(pos)
+            self._file.write(struct.pack(fmt, *values))
+
+        patch(4, "<I", file_end - 8)
+        patch(self._movi_pos + 4, "<I", movi_end - self._movi_pos - 8)
+        patch(self._avih_pos + 8 + 16, "<I", len(self._index))
+        patch(self._avih_pos + 8 + 28, "<I", self._max_frame)
+        patch(self._strh_pos + 8 + 32, "<II", len(self._index), self._max_frame)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
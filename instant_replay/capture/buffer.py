@@ -0,0 +1,582 @@
+import bisect
+import mmap
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import instant_replay.values as values
+
+_FREE = np.iinfo(np.uint64).max
+_MAGIC = 0x3130464552504952  # "RIPREF01" - layout version of persistent buffers
+
+_HEADER_DTYPE = np.dtype([
+    ('magic', np.uint64),
+    ('capacity', np.uint64),
+    ('data_size', np.uint64),
+    ('count', np.uint64),    # Number of frames published so far (next sequence number)
+    ('reserve', np.uint64),  # Logical end of the region the writer is about to overwrite
+    ('floor', np.uint64),    # Frames with a lower sequence number are no longer offered for export
+    ('pin_seq', np.uint64, (values.MAX_SNAPSHOTS,)),  # First frame of every snapshot, _FREE if unused
+    ('pin_pos', np.uint64, (values.MAX_SNAPSHOTS,)),  # Logical byte position of that frame
+])
+
+_INDEX_DTYPE = np.dtype([
+    ('seq', np.uint64),
+    ('pos', np.uint64),   # Logical (ever-growing) byte position of the frame data
+    ('size', np.uint32),
+    ('kind', np.uint32),  # values.FRAME_KEY, FRAME_DELTA or FRAME_REPEAT
+    ('time', np.uint64),  # perf_counter_ns capture time
+    ('wall', np.uint64),  # time_ns capture time, survives restarts
+    ('crc', np.uint32),   # CRC-32 of the frame data, only computed for persistent buffers
+])
+
+
+class FrameBuffer:
+    """
+    Fixed-capacity ring buffer of encoded frames living in shared memory.
+    With `path` set, the frame data lives in a preallocated memory-mapped file instead and only the header and
+    the index stay in RAM, so long replays don't need more memory.
+
+    There must be only one writer (the converting process). Writes are lock-free: the data is copied first,
+    then the index entry, and only then the frame is published by bumping the counter. Readers never block
+    the writer - every read is validated after the fact and frames overwritten in the meantime are skipped.
+    The oldest frames are overwritten implicitly, both when the index is full and when the data region runs
+    out of bytes - unless they are pinned by a snapshot, then the new frame is dropped instead.
+    """
+
+    def __init__(self,
+                 capacity,
+                 data_size,
+                 name=None,
+                 path=None,
+                 persistent=False):
+        """
+        :param name: attach to an existing buffer - name of its shared memory block (or of its index file if the
+                     buffer is persistent), None - create a new buffer
+        :param path: file to keep the frame data in, None - keep it in shared memory
+        :param persistent: keep the header and the index in a file next to the data too, so the frames can be
+                           recovered after a crash
+        """
+        self.capacity = int(capacity)
+        self.data_size = int(data_size)
+        self.path = path
+        self.persistent = persistent
+        self.recovered = 0  # Frames recovered from a previous run
+        self._index_offset = _HEADER_DTYPE.itemsize
+        self._data_offset = self._index_offset + _INDEX_DTYPE.itemsize * self.capacity
+        self._owner = name is None
+
+        self._shm = None
+        self._meta_mmap = None
+        if self.persistent:
+            self._meta_mmap = self._open_file(self.path + values.INDEX_FILE_SUFFIX, self._data_offset)
+        elif self._owner:
+            shm_size = self._data_offset + (self.data_size if self.path is None else 0)
+            self._shm = shared_memory.SharedMemory(create=True, size=shm_size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._mmap = None
+        if self.path is not None:
+            self._mmap = self._open_file(self.path, self.data_size)
+        self._map()
+
+        if self._owner and not (self.persistent and self._recover()):
+            self._header[...] = 0
+            self._header['magic'] = _MAGIC
+            self._header['capacity'] = self.capacity
+            self._header['data_size'] = self.data_size
+            self._header['pin_seq'] = _FREE
+            self._index['seq'] = _FREE
+
+        self._pin_lock = threading.Lock()
+        self._wall_offset = None  # time_ns() - perf_counter_ns(), set by the writer
+
+    @classmethod
+    def from_config(cls, length, fps, ram_usage, path=None, disk_usage=values.DEFAULT_DISK_USAGE, persistent=False):
+        """
+        :param ram_usage: budget in bytes for the whole shared memory block, index included
+        :param path: file to keep the frame data in, None - keep it in RAM
+        :param disk_usage: size of the file in bytes
+        :param persistent: recover frames left in the file by a previous run and keep them for the next one
+        """
+        # Leave room in the index for frames pinned by exports while new ones keep coming
+        capacity = max(1, int(length * fps * values.BUFFER_HEADROOM))
+        if path is not None:
+            return cls(capacity, disk_usage, path=path, persistent=persistent)
+        index_size = _HEADER_DTYPE.itemsize + _INDEX_DTYPE.itemsize * capacity
+        return cls(capacity, max(1, ram_usage - index_size))
+
+    def _open_file(self, path, size):
+        """
+        Map a file shared by all processes using the buffer. The owner allocates all of its blocks up front;
+        a persistent buffer keeps the previous contents if the size matches.
+        """
+        if self._owner:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        flags = os.O_RDWR | getattr(os, "O_BINARY", 0)
+        if self._owner:
+            flags |= os.O_CREAT if self.persistent else os.O_CREAT | os.O_TRUNC
+        fd = os.open(path, flags, 0o666)
+        try:
+            if self._owner and os.fstat(fd).st_size != size:
+                os.truncate(fd, 0)
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.truncate(fd, size)
+            return mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def _recover(self):
+        """
+        Reuse the header and the index left by a previous run. Only the index is touched, the frame data is
+        validated lazily with its checksum when read.
+        :return: False if there is nothing to recover
+        """
+        if self._header['magic'] != _MAGIC or self._header['capacity'] != self.capacity or \
+                self._header['data_size'] != self.data_size:
+            return False
+
+        # Snapshots died with their processes
+        self._header['pin_seq'] = _FREE
+
+        # perf_counter_ns is only meaningful within one boot - rebase the capture times using the wall clock
+        offset = time.time_ns() - time.perf_counter_ns()
+        used = self._index['seq'] != _FREE
+        self._index['time'][used] = np.maximum(self._index['wall'][used].astype(np.int64) - offset, 0)
+
+        first, end = self.sequence_range()
+        self.recovered = end - first
+        return True
+
+    def _map(self):
+        meta = self._shm.buf if self._shm is not None else memoryview(self._meta_mmap)
+        self._header = np.ndarray((), dtype=_HEADER_DTYPE, buffer=meta)
+        self._index = np.ndarray((self.capacity,), dtype=_INDEX_DTYPE, buffer=meta, offset=self._index_offset)
+        if self._mmap is None:
+            self._data = self._shm.buf[self._data_offset:self._data_offset + self.data_size]
+        else:
+            self._data = memoryview(self._mmap)
+
+    def _unmap(self):
+        self._data.release()
+        del self._header
+        del self._index
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._meta_mmap is not None:
+            self._meta_mmap.close()
+
+    def __getstate__(self):
+        name = self._shm.name if self._shm is not None else self.path + values.INDEX_FILE_SUFFIX
+        return self.capacity, self.data_size, name, self.path, self.persistent
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        first, end = self.sequence_range()
+        return sum(1 for seq in range(first, end) if self.is_valid(seq))
+
+    # ---------------------------------------------------------------------------------
+    # Writer side
+
+    def append(self, data, kind=values.FRAME_KEY, timestamp=0):
+        """
+        Publish a new frame. Must only be called from a single process.
+        :param data: bytes-like object with the encoded frame
+        :param kind: values.FRAME_KEY, FRAME_DELTA or FRAME_REPEAT
+        :param timestamp: perf_counter_ns capture time, never lower than the previous one
+        :return: False if the frame was dropped - it's bigger than the whole buffer or would overwrite
+                 frames pinned by a snapshot
+        """
+        size = len(data)
+        if size > self.data_size:
+            return False
+
+        seq = int(self._header['count'])
+        pos = int(self._header['reserve'])
+        if pos % self.data_size + size > self.data_size:  # Never split a frame - wrap to the start
+            pos = (pos // self.data_size + 1) * self.data_size
+        start = pos % self.data_size
+
+        pinned = self._header['pin_seq'] != _FREE
+        if pinned.any():
+            if seq - self.capacity >= int(self._header['pin_seq'][pinned].min()) or \
+                    pos + size - self.data_size > int(self._header['pin_pos'][pinned].min()):
+                return False
+
+        if self._wall_offset is None:
+            self._wall_offset = time.time_ns() - time.perf_counter_ns()
+
+        self._header['reserve'] = pos + size
+        self._data[start:start + size] = data
+
+        entry = self._index[seq % self.capacity]
+        entry['seq'] = _FREE  # Readers of the frame stored here before see it's being replaced, see _entry
+        entry['pos'] = pos
+        entry['size'] = size
+        entry['kind'] = kind
+        entry['time'] = timestamp
+        entry['wall'] = timestamp + self._wall_offset
+        entry['crc'] = zlib.crc32(data) if self.persistent else 0
+        entry['seq'] = seq
+
+        self._header['count'] = seq + 1
+        return True
+
+    # ---------------------------------------------------------------------------------
+    # Reader side
+
+    def _entry(self, seq):
+        """
+        Consistent copy of an index entry. The writer marks the entry _FREE while it rewrites it, so the copy is
+        only valid if the sequence number still matches after it was taken.
+        :return: numpy record or None if the frame is no longer indexed
+        """
+        slot = seq % self.capacity
+        entry = self._index[slot].copy()
+        if int(entry['seq']) != seq or int(self._index[slot]['seq']) != seq:
+            return None
+        return entry
+
+    def _is_intact(self, entry):
+        return int(entry['pos']) + self.data_size >= int(self._header['reserve'])
+
+    def sequence_range(self, n=None, since=None, duration=None):
+        """
+        :param n: maximum number of newest frames to include, all buffered frames if None
+        :param since: perf_counter_ns timestamp, include only frames captured at or after it
+        :param duration: nanoseconds, include only frames captured at most this long before the newest one
+        :return: (first, end) sequence numbers of the newest frames, end exclusive
+        """
+        end = int(self._header['count'])
+        first = max(int(self._header['floor']), end - self.capacity, 0)
+        if n is not None:
+            first = max(first, end - n)
+        if duration is not None and first < end and (newest := self.timestamp(end - 1)) is not None:
+            since = max(since or 0, newest - duration)
+        if since is not None:
+            first = self.seq_at(since, first, end)
+        return first, end
+
+    def seq_at(self, timestamp, first, end):
+        """
+        Binary search of the index, no frame data is touched
+        :return: sequence number of the first frame in [first, end) captured at or after `timestamp`
+        """
+        def time_of(seq):
+            entry = self._entry(seq)
+            return 0 if entry is None else int(entry['time'])  # Overwritten frames are the oldest ones
+
+        return first + bisect.bisect_left(range(first, end), timestamp, key=time_of)
+
+    def timestamp(self, seq):
+        """
+        :return: perf_counter_ns capture time of the frame or None if it is no longer buffered
+        """
+        entry = self._entry(seq)
+        return None if entry is None else int(entry['time'])
+
+    def used_bytes(self):
+        """
+        Measured size of the buffered frames, including the gaps left where frames skipped to the start
+        :return: (bytes, number of frames)
+        """
+        first, end = self.sequence_range()
+        while first < end and not self.is_valid(first):
+            first += 1
+        entry = self._entry(first) if first < end else None
+        if entry is None:
+            return 0, 0
+        return int(self._header['reserve']) - int(entry['pos']), end - first
+
+    def view(self, seq):
+        """
+        Zero-copy access to a frame. The returned memoryview points directly into shared memory, so the caller
+        must check `is_valid(seq)` after using it - the writer may have overwritten it in the meantime.
+        :return: memoryview or None if the frame is no longer buffered
+        """
+        entry = self._entry(seq)
+        if entry is None or not self._is_intact(entry):
+            return None
+        start = int(entry['pos']) % self.data_size
+        return self._data[start:start + int(entry['size'])]
+
+    def is_valid(self, seq):
+        entry = self._entry(seq)
+        return entry is not None and self._is_intact(entry)
+
+    def read(self, seq):
+        """
+        :return: (kind, copy of the frame data, capture timestamp) or None if it was overwritten
+        """
+        entry = self._entry(seq)
+        view = self.view(seq)
+        if view is None:
+            return None
+        data = bytes(view)
+        view.release()
+        if not self.is_valid(seq) or (self.persistent and zlib.crc32(data) != entry['crc']):
+            return None
+        return int(entry['kind']), data, int(entry['time'])
+
+    def iter_frames(self, first, end):
+        """
+        Lazily copy frames out of the buffer one at a time, oldest first. Frames overwritten before they were
+        reached are skipped.
+        :param first: first sequence number
+        :param end: sequence number after the last frame
+        :return: generator of (kind, bytes, timestamp)
+        """
+        for seq in range(first, end):
+            frame = self.read(seq)
+            if frame is not None:
+                yield frame
+
+    def frames(self, n=None):
+        """
+        Copy the newest frames out of the buffer, oldest first. Frames overwritten while reading are skipped.
+        :param n: maximum number of frames
+        :return: list of (kind, bytes, timestamp)
+        """
+        return list(self.iter_frames(*self.sequence_range(n)))
+
+    def snapshot(self, n=None, since=None, duration=None):
+        """
+        Pin the newest frames, so the writer won't overwrite them until `release` is called. No data is copied.
+        Snapshots may overlap, and the pin may be released from another process. The pin also covers the frames
+        back to the closest keyframe, so delta frames at the start can be decoded, see `pinned`.
+        :param n: maximum number of frames
+        :param since: perf_counter_ns timestamp of the oldest frame to include
+        :param duration: nanoseconds of the newest frames to include
+        :return: (pin, first, end) or None if there are too many snapshots already
+        """
+        with self._pin_lock:
+            free = np.flatnonzero(self._header['pin_seq'] == _FREE)
+            if not len(free):
+                return None
+            pin = int(free[0])
+
+            first, end = self.sequence_range(n, since, duration)
+            start = first
+            oldest, _ = self.sequence_range()
+            while first > oldest and (entry := self._entry(first)) is not None and \
+                    entry['kind'] != values.FRAME_KEY and self._entry(first - 1) is not None:
+                first -= 1
+            while first < end and (entry := self._entry(first)) is None:
+                first += 1
+            self._header['pin_pos'][pin] = entry['pos'] if first < end else self._header['reserve']
+            self._header['pin_seq'][pin] = first
+
+            # The writer could have overwritten the oldest frames before it noticed the pin
+            while first < end and not self.is_valid(first):
+                first += 1
+            return pin, max(first, start), end
+
+    def pinned(self, pin):
+        """
+        :return: sequence number of the oldest frame kept by the pin - the keyframe the snapshot's frames are
+                 decoded from
+        """
+        return int(self._header['pin_seq'][pin])
+
+    def release(self, pin):
+        self._header['pin_seq'][pin] = _FREE
+
+    def clear(self, end=None):
+        """
+        Stop offering frames published so far for export. Safe to call from any process while the writer is
+        running. Frames stay readable until they are overwritten, so snapshots are not affected.
+        :param end: drop only the frames with lower sequence numbers
+        """
+        self._header['floor'] = self._header['count'] if end is None else max(end, int(self._header['floor']))
+
+    # ---------------------------------------------------------------------------------
+    # Lifetime
+
+    def flush(self):
+        """
+        Write the frames of a persistent buffer to disk, so they survive a system crash too. Frames are never
+        lost when only the app crashes.
+        """
+        if self.persistent:
+            self._meta_mmap.flush()
+            self._mmap.flush()
+
+    def close(self):
+        self._unmap()
+        if self._shm is not None:
+            self._shm.close()
+
+    def unlink(self):
+        """
+        Close and free the shared memory and remove the data file. Only the process that created the buffer
+        should call it. Persistent buffers keep their files.
+        """
+        self.close()
+        if self._owner and not self.persistent:
+            if self._shm is not None:
+                self._shm.unlink()
+            if self.path is not None:
+                os.remove(self.path)
+
+
+class RawFrameSlots:
+    """
+    Preallocated shared-memory slots for raw BGRA screenshots. Only slot indices travel through the queue, the
+    pixels are copied once into a slot by the recorder and read in place by the converter. Free slot indices
+    are handed back through `free_queue`, so the number of frames in flight can never exceed the number of slots.
+    The recorder also publishes which slot holds the newest frame, so screenshots can be copied from it.
+    """
+
+    def __init__(self,
+                 n_slots,
+                 slot_size,
+                 free_queue=None,
+                 name=None,
+                 shared=None):
+        self.n_slots = int(n_slots)
+        self.slot_size = int(slot_size)
+        self.free_queue = free_queue
+        self._owner = name is None
+        if shared is None:
+            # Write count of every slot, odd while the slot is being written
+            self._writes = multiprocessing.RawArray('Q', self.n_slots)
+            # Newest frame: change count (odd while it changes), slot, width, height, timestamp
+            self._latest = multiprocessing.RawArray('q', 5)
+            self._latest[1] = -1
+        else:
+            self._writes, self._latest = shared
+
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=self.n_slots * self.slot_size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+
+        if self._owner and self.free_queue is not None:
+            self.release_all()
+
+    def __getstate__(self):
+        return self.n_slots, self.slot_size, self.free_queue, self._shm.name, (self._writes, self._latest)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def acquire(self):
+        """
+        :return: index of a free slot or None if all of them are in use
+        """
+        try:
+            return self.free_queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def release(self, slot):
+        self.free_queue.put(slot)
+
+    def release_all(self):
+        for slot in range(self.n_slots):
+            self.free_queue.put(slot)
+
+    def write(self, slot, data):
+        size = len(data)
+        start = slot * self.slot_size
+        self._writes[slot] += 1
+        self._shm.buf[start:start + size] = data
+        self._writes[slot] += 1
+
+    def publish_latest(self, slot, size, timestamp):
+        """
+        Mark a written slot as the newest frame. Single writer - the recorder.
+        :param size: (width, height) of the frame
+        """
+        self._latest[0] += 1
+        self._latest[1:5] = [slot, size[0], size[1], timestamp]
+        self._latest[0] += 1
+
+    def latest(self, max_age=None, tries=3):
+        """
+        Copy of the newest frame, checked against concurrent writes
+        :param max_age: ignore frames grabbed longer ago, in nanoseconds
+        :return: (raw BGRA bytes, (width, height), timestamp) or None if there is no such frame
+        """
+        for _ in range(tries):
+            change = self._latest[0]
+            slot, width, height, timestamp = self._latest[1:5]
+            if change % 2 or self._latest[0] != change:
+                continue
+            if slot < 0:
+                return None
+            if max_age is not None and time.perf_counter_ns() - timestamp > max_age:
+                return None
+            writes = self._writes[slot]
+            if writes % 2:
+                continue
+            start = slot * self.slot_size
+            raw = bytes(self._shm.buf[start:start + width * height * 4])
+            if self._writes[slot] == writes:
+                return raw, (width, height), timestamp
+        return None
+
+    def array(self, slot, size):
+        """
+        Zero-copy access to a slot
+        :param size: (width, height) of the frame
+        :return: numpy array of shape (height, width, 4)
+        """
+        width, height = size
+        return np.ndarray((height, width, 4), dtype=np.uint8, buffer=self._shm.buf, offset=slot * self.slot_size)
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class TransportStats:
+    """
+    Counters shared between the recording and converting processes. Every counter has a single writer,
+    so no locking is needed.
+    """
+    GRABBED = 0  # Written by the recorder
+    DROPPED = 1  # Written by the recorder
+    CONVERTED = 2  # Written by the converter
+    QUALITY = 3  # Written by the converter, JPEG quality currently used
+    FRAME_STEP = 4  # Written by the converter, every n-th frame is encoded
+
+    def __init__(self):
+        self._counters = multiprocessing.RawArray('q', 5)
+
+    def increment(self, counter):
+        self._counters[counter] += 1
+
+    def set(self, counter, value):
+        self._counters[counter] = value
+
+    def reset(self):
+        for i in range(len(self._counters)):
+            self._counters[i] = 0
+
+    def get(self):
+        grabbed, dropped, converted, quality, frame_step = self._counters[:]
+        return {
+            'grabbed': grabbed,
+            'dropped': dropped,
+            'converted': converted,
+            'queue_depth': grabbed - converted,
+            'quality': quality,
+            'frame_step': frame_step,
+        }
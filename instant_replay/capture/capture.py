@@ -1,42 +1,102 @@
 import errno
+import heapq
+import itertools
 import multiprocessing
+import math
 import os
+import queue
 import re
+import shutil
+import subprocess
+import tempfile
+import threading
 import time
 from abc import abstractmethod
+from collections import deque
+from collections.abc import Iterable
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from io import BytesIO
-from multiprocessing import Queue, Pipe, Manager
+from multiprocessing import Queue, Pipe
 
-import cv2
-import mss
 import numpy as np
-from PIL import Image
 
 import instant_replay.values as values
+from instant_replay.lazy import lazy_import
+from instant_replay.capture.avi import AviWriter
+from instant_replay.capture.buffer import FrameBuffer, RawFrameSlots, TransportStats
+from instant_replay.capture.delta import DeltaDecoder, encode_delta
+from instant_replay.capture.metrics import MetricsServer, PipelineMetrics
+from instant_replay.capture.pacing import FramePacer, PacingStats
+from instant_replay.capture.segments import SegmentEncoder, SegmentSnapshot, SegmentStore, segments_available
+from instant_replay.capture.sources import FrameSource, RawFrame, make_source, parse_region
+
+cv2 = lazy_import("cv2")
+Image = lazy_import("PIL.Image")
+
+
+def parse_resolution(text):
+    """
+    :return: (width, height) parsed from a "WIDTHxHEIGHT" string or None for the native resolution
+    """
+    match = re.fullmatch(r"(?P<width>\d+)x(?P<height>\d+)", text or "")
+    return (int(match['width']), int(match['height'])) if match else None
+
+
+def scaled_size(size, resolution):
+    """
+    Largest size with the aspect ratio of `size` that fits into `resolution`. Frames are never upscaled.
+    :param size: (width, height) of the captured frame
+    :param resolution: (width, height) bounding box or None for the native size
+    """
+    width, height = size
+    if resolution is None or (width <= resolution[0] and height <= resolution[1]):
+        return width, height
+    ratio = min(resolution[0] / width, resolution[1] / height)
+    # Video codecs expect even dimensions
+    return max(2, int(width * ratio) // 2 * 2), max(2, int(height * ratio) // 2 * 2)
+
+
+def downscale(bgra, resolution):
+    """
+    Area-averaging resize of a raw frame, so it fits into `resolution`
+    :param bgra: numpy array of shape (height, width, 4)
+    :return: resized array or `bgra` itself if it already fits
+    """
+    size = scaled_size((bgra.shape[1], bgra.shape[0]), resolution)
+    if size == (bgra.shape[1], bgra.shape[0]):
+        return bgra
+    return cv2.resize(bgra, size, interpolation=cv2.INTER_AREA)
 
 
 class Frame:
     def __init__(self,
-                 sct_img,
+                 data,
                  format_,
-                 quality,
-                 scale: tuple = None):
-        self.buffered_img = BytesIO()
-        self.size = sct_img.size
+                 size: tuple = None,
+                 kind=values.FRAME_KEY,
+                 timestamp=None,
+                 lead_in=False):
+        self.buffered_img = BytesIO(data)
+        self.size = size
         self.format_ = format_
+        self.kind = kind  # FRAME_DELTA and FRAME_REPEAT frames can only be decoded in order, see decode_frames
+        self.timestamp = timestamp  # perf_counter_ns capture time, None if unknown
+        self.lead_in = lead_in  # Only decoded for the frames after it, not part of the video
 
-        img = Image.frombytes("RGB", self.size, sct_img.bgra, "raw", "BGRX") if hasattr(sct_img, "bgra") \
-            else Image.frombytes("RGB", self.size, sct_img, "raw", "BGRX")
-        # if scale is not None:
-        #     try:
-        #         print("---------------")
-        #         print(img.size, asizeof(img))
-        #         tmp = img.resize(scale),  # todo przekazac wybrana przez uzytkownika roz mniejsza niz ralna monitora
-        #         img = tmp[0]
-        #         print(img.size, asizeof(img))
-        #     except Exception as e:
-        #         print(e)
-        img.save(self.buffered_img, format=format_, quality=quality)
+    @classmethod
+    def from_raw(cls,
+                 raw,
+                 size,
+                 format_,
+                 quality,
+                 scale: tuple = None):
+        bgra = np.frombuffer(raw, dtype=np.uint8, count=size[0] * size[1] * 4).reshape((size[1], size[0], 4))
+        if scale is not None:
+            bgra = downscale(bgra, scale)
+        img = Image.frombuffer("RGB", (bgra.shape[1], bgra.shape[0]), bgra, "raw", "BGRX", 0, 1)
+        buffered_img = BytesIO()
+        img.save(buffered_img, format=format_, quality=quality)
+        return cls(buffered_img.getvalue(), format_, img.size)
 
     def to_file(self, path_):
         with open(path_, mode="wb") as file:
@@ -46,7 +106,96 @@ class Frame:
         return Image.open(self.buffered_img, formats=(self.format_,))
 
 
+def decode_frames(frames: Iterable[Frame]):
+    """
+    Decode frames in order into BGR numpy arrays, rebuilding delta and repeated frames. Leading deltas without
+    a keyframe before them and lead-in frames are skipped.
+    :return: generator of (capture timestamp, BGR numpy array)
+    """
+    decoder = DeltaDecoder()
+    for frame in frames:
+        img = decoder.decode(frame.kind, frame.buffered_img.getbuffer())
+        if img is not None and not frame.lead_in:
+            yield frame.timestamp, img
+
+
+def constant_rate(items, fps):
+    """
+    Resample timestamped items to a constant frame rate. Every output tick gets the newest item captured
+    before it (within half a frame), so items are repeated where frames were late or dropped and skipped where
+    they came too fast. Gaps longer than EXPORT_MAX_GAP seconds (e.g. a restart) are cut short.
+    Items without a timestamp are passed through as they are.
+    :param items: iterable of (perf_counter_ns timestamp or None, item) in capture order
+    :return: generator of items, one per 1 / fps seconds
+    """
+    interval = pow(10, 9) / fps
+    max_gap = values.EXPORT_MAX_GAP * pow(10, 9)
+    tick = None
+    previous = None
+    for timestamp, item in items:
+        if timestamp is None:
+            yield item
+            continue
+        if tick is None:
+            tick = timestamp
+        if previous is not None and timestamp - tick > max_gap:
+            yield previous
+            tick = timestamp
+        while previous is not None and tick + interval / 2 < timestamp:
+            yield previous
+            tick += interval
+        previous = item
+    if previous is not None:
+        yield previous
+
+
+_PREFETCH_END = object()
+
+
+def prefetch(iterable, depth=values.EXPORT_PREFETCH):
+    """
+    Evaluate `iterable` in a background thread, at most `depth` items ahead of the consumer. Decoding and
+    writing frames both release the GIL, so the next frames are decoded while the current one is written.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put(_PREFETCH_END)
+        except Exception as e:
+            items.put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while (item := items.get()) is not _PREFETCH_END:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
 class FileSaver:
+    """
+    Picks free numbered paths (directory/prefix_N.extension). The directory is listed only once per process,
+    then names are handed out from an in-memory index. Every name is claimed by creating the file exclusively,
+    so concurrent exports and files created by others never clash.
+    """
+    # (directory, prefix, extension) -> [heap of free indices below `next`, next index after the highest used one]
+    _indices = {}
+    _lock = threading.Lock()
+
     def __init__(self,
                  directory,
                  file_prefix,
@@ -65,73 +214,271 @@ class FileSaver:
             else:
                 raise
 
-    def get_free_path(self):
+    def _key(self):
+        return os.path.abspath(self.directory), self.file_prefix, self.file_extension
+
+    def _scan(self):
+        """
+        List the directory once
+        :return: [heap of free indices between the used ones, next index after the highest used one]
+        """
         self._mkdir_p()
-        files = [(file, match) for file in os.listdir(self.directory)
-                 if (match :=
-                     re.match(re.escape(self.file_prefix) + r"_(?P<value>.*)\." + re.escape(self.file_extension), file)
-                     )]
+        pattern = re.compile(re.escape(self.file_prefix) + r"_(?P<value>\d+)\." + re.escape(self.file_extension) + "$")
+        used = set()
+        for file in os.listdir(self.directory):
+            if match := pattern.match(file):
+                used.add(int(match['value']))
+        end = max(used) + 1 if used else 0
+        gaps = list(itertools.islice((i for i in range(end) if i not in used), values.FILE_MAX_GAPS))
+        return [gaps, end]  # A sorted list is a heap
+
+    def _state(self, key):
+        state = FileSaver._indices.get(key)
+        if state is None:
+            state = FileSaver._indices[key] = self._scan()
+        return state
+
+    def prepare(self):
+        """
+        List the directory in a background thread, so the first save doesn't have to
+        """
+        def scan():
+            with FileSaver._lock:
+                self._state(self._key())
+
+        threading.Thread(target=scan, daemon=True).start()
 
-        vals = set()
-        for file, match in files:
+    def get_free_path(self):
+        """
+        :return: path to a new, empty file
+        """
+        key = self._key()
+        while True:
+            with FileSaver._lock:
+                state = self._state(key)
+                if state[0]:
+                    index = heapq.heappop(state[0])
+                else:
+                    index = state[1]
+                    state[1] += 1
+            path = os.path.join(self.directory, self.file_prefix + "_" + str(index) + "." + self.file_extension)
             try:
-                vals.add(int(match['value']))
-            except ValueError:
-                pass
-
-        cnt = 0
-        for val in sorted(vals):
-            if val == cnt:
-                cnt += 1
-            else:
-                break
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            except FileExistsError:
+                continue  # Created since the directory was listed
+            except FileNotFoundError:
+                with FileSaver._lock:
+                    FileSaver._indices.pop(key, None)  # The directory was removed, list it again
+                continue
+            return path
+
+    @staticmethod
+    def discard(path):
+        """
+        Remove a claimed file that couldn't be written, e.g. a partial export
+        """
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
-        return os.path.join(self.directory, self.file_prefix + "_" + str(cnt) + "." + self.file_extension)
+    @staticmethod
+    def reset():
+        """
+        Start over in a new process. A forked process may inherit the lock held by a prepare() thread that
+        doesn't exist there, and an index that was being changed.
+        """
+        FileSaver._lock = threading.Lock()
+        FileSaver._indices = {}
 
 
 class VideoEncoder:
+    extension = None  # of the written files
+
     def __init__(self,
                  fps,
                  file_saver: FileSaver):
         self.fps = fps
         self.file_saver = file_saver
 
+    @classmethod
+    def available(cls):
+        """
+        :return: False if a program or library the encoder needs is missing on this system
+        """
+        return True
+
     @abstractmethod
-    def encode(self, frames: list[Frame], screen_size):
+    def encode(self, frames: Iterable[Frame], screen_size):
+        """
+        :param frames: frames in order, may be a generator pulling them lazily from the buffer
+        :param screen_size: (width, height) of the frames
+        :return: path of the written file
+        """
         pass
 
+    @staticmethod
+    def _discard(path):
+        """
+        Remove a partially written file after the export failed or was cancelled
+        """
+        FileSaver.discard(path)
+
 
 class Mp4VideoEncoder(VideoEncoder):
+    extension = "mp4"
+
     def __init__(self,
                  fps,
                  file_saver: FileSaver = FileSaver("videos", "video", "mp4")):
         super().__init__(fps, file_saver)
 
     # noinspection PyUnresolvedReferences
-    def encode(self, frames: list[Frame], screen_size):
+    def encode(self, frames: Iterable[Frame], screen_size):
         output_path = self.file_saver.get_free_path()
 
         fourcc = cv2.VideoWriter_fourcc(*"mp4v")
         out = cv2.VideoWriter(output_path, fourcc, self.fps, screen_size)
 
-        for frame in frames:
-            out.write(cv2.cvtColor(np.array(frame.get()), cv2.COLOR_RGB2BGR))
+        try:
+            for img in prefetch(constant_rate(decode_frames(frames), self.fps)):
+                out.write(img)
+        except BaseException:
+            out.release()
+            self._discard(output_path)
+            raise
         out.release()
+        return output_path
 
 
-class SomeOtherVideoEncoder(VideoEncoder):
-    # todo new encoding
+class MjpegVideoEncoder(VideoEncoder):
+    """
+    Writes the buffered JPEG frames straight into an MJPEG AVI file, without decoding or re-encoding them
+    """
+    extension = "avi"
+
     def __init__(self,
                  fps,
-                 file_saver: FileSaver = FileSaver("videos", "video", "mp4")):
+                 file_saver: FileSaver = FileSaver("videos", "video", "avi")):
         super().__init__(fps, file_saver)
 
-    def encode(self, frames: list[Frame], screen_size):
-        ...
+    @staticmethod
+    def _jpegs(frames: Iterable[Frame]):
+        """
+        :return: generator of (capture timestamp, JPEG), only delta frames are decoded and re-encoded
+        """
+        decoder = DeltaDecoder()
+        stale_key = None  # Keyframe not decoded yet - only needed if a delta frame follows
+        last_jpeg = None
+        last_img = None  # Decoded frame not encoded yet - lead-in frames are only encoded if they are repeated
+        for frame in frames:
+            data = frame.buffered_img.getbuffer()
+            if frame.kind == values.FRAME_KEY and frame.format_ == values.CAPTURE_JPEG:
+                last_jpeg, stale_key, last_img = data, data, None
+            elif frame.kind == values.FRAME_REPEAT:
+                if last_jpeg is None and last_img is None:
+                    continue
+            else:
+                if stale_key is not None:
+                    decoder.decode(values.FRAME_KEY, stale_key)
+                    stale_key = None
+                if (img := decoder.decode(frame.kind, data)) is None:
+                    continue
+                last_jpeg, last_img = None, img
+            if frame.lead_in:
+                continue
+            if last_jpeg is None:
+                last_jpeg = cv2.imencode(".jpg", last_img)[1]
+            yield frame.timestamp, last_jpeg
+
+    def encode(self, frames: Iterable[Frame], screen_size):
+        output_path = self.file_saver.get_free_path()
+
+        out = AviWriter(output_path, self.fps, screen_size)
+        try:
+            for jpeg in constant_rate(self._jpegs(frames), self.fps):
+                out.write(jpeg)
+        except BaseException:
+            out.close()
+            self._discard(output_path)
+            raise
+        out.close()
+        return output_path
+
+
+class FfmpegVideoEncoder(VideoEncoder):
+    """
+    Streams the buffered JPEG frames to an ffmpeg process that decodes them and encodes `codec` on all cores.
+    Only delta frames are decoded here, like in MjpegVideoEncoder.
+    """
+    extension = "mp4"
+    codec = None  # ffmpeg encoder name
+
+    def __init__(self,
+                 fps,
+                 file_saver: FileSaver = FileSaver("videos", "video", "mp4"),
+                 preset=values.DEFAULT_VIDEO_PRESET):
+        """
+        :param preset: key of FFMPEG_PRESETS - fast export or small files
+        """
+        super().__init__(fps, file_saver)
+        self.preset = preset
+
+    @classmethod
+    def available(cls):
+        return shutil.which(values.FFMPEG_BINARY) is not None
+
+    def _command(self, output_path):
+        return [values.FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+                "-f", "image2pipe", "-c:v", "mjpeg", "-framerate", str(self.fps), "-i", "-",
+                "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",  # yuv420p needs even dimensions
+                "-c:v", self.codec, *values.FFMPEG_PRESETS[self.codec][self.preset],
+                "-pix_fmt", "yuv420p", "-threads", str(values.FFMPEG_THREADS),
+                "-movflags", "+faststart", output_path]
+
+    def encode(self, frames: Iterable[Frame], screen_size):
+        output_path = self.file_saver.get_free_path()
+
+        # Errors go to a file - a pipe that isn't read while the frames are written could fill up and block ffmpeg
+        with tempfile.TemporaryFile() as log:
+            process = subprocess.Popen(self._command(output_path), stdin=subprocess.PIPE,
+                                       stdout=subprocess.DEVNULL, stderr=log)
+            try:
+                for jpeg in prefetch(constant_rate(MjpegVideoEncoder._jpegs(frames), self.fps)):
+                    process.stdin.write(jpeg)
+                process.stdin.close()
+                if process.wait() != 0:
+                    raise RuntimeError(f"ffmpeg failed: {self._errors(log)}")
+            except BrokenPipeError:
+                process.kill()
+                process.wait()
+                self._discard(output_path)
+                raise RuntimeError(f"ffmpeg failed: {self._errors(log)}")
+            except BaseException:
+                process.kill()
+                process.wait()
+                self._discard(output_path)
+                raise
+        return output_path
+
+    @staticmethod
+    def _errors(log):
+        log.seek(0)
+        return log.read().decode(errors="replace").strip()
+
+
+class H264VideoEncoder(FfmpegVideoEncoder):
+    codec = "libx264"
+
+
+class HevcVideoEncoder(FfmpegVideoEncoder):
+    codec = "libx265"
 
 
 VID_ENCODERS = {"mp4": Mp4VideoEncoder,
-                "other": SomeOtherVideoEncoder
+                "avi": MjpegVideoEncoder,
+                "h264": H264VideoEncoder,
+                "hevc": HevcVideoEncoder
                 }
 
 
@@ -142,6 +489,9 @@ class PhotoEncoder:
 
     @abstractmethod
     def encode(self, sct_img, screen_size, scale=None):
+        """
+        :return: path to the saved screenshot
+        """
         pass
 
 
@@ -152,7 +502,13 @@ class PngEncoder(PhotoEncoder):
 
     def encode(self, sct_img, screen_size, scale=None):
         img = Image.frombytes("RGB", screen_size, sct_img.bgra, "raw", "BGRX")
-        img.save(self.file_saver.get_free_path(), format=values.CAPTURE_PNG, quality=95)
+        path = self.file_saver.get_free_path()
+        try:
+            img.save(path, format=values.CAPTURE_PNG, quality=95)
+        except BaseException:
+            FileSaver.discard(path)
+            raise
+        return path
 
 
 class JpegEncoder(PhotoEncoder):
@@ -162,14 +518,14 @@ class JpegEncoder(PhotoEncoder):
         ...
 
     def encode(self, sct_img, screen_size, scale=None):
-        if scale:
-            try:
-                width, height = scale
-                sct_img = cv2.resize(sct_img, (width, height))
-            except Exception as e:
-                print(e)
-        img = Image.frombytes("RGB", screen_size, sct_img.bgra, "raw", "BGRX")
-        img.save(self.file_saver.get_free_path(), format=values.CAPTURE_PNG, quality=95)
+        frame = Frame.from_raw(sct_img.bgra, screen_size, values.CAPTURE_JPEG, 95, scale)
+        path = self.file_saver.get_free_path()
+        try:
+            frame.to_file(path)
+        except BaseException:
+            FileSaver.discard(path)
+            raise
+        return path
 
 
 P_ENCODERS = {
@@ -180,73 +536,221 @@ P_ENCODERS = {
 
 class RecorderProcess(multiprocessing.Process):
     def __init__(self,
-                 img_queue,
+                 outputs,
                  rec_conn,
-                 shot_conn,
                  interval,
-                 display,
+                 source: FrameSource,
+                 pacing_stats: PacingStats,
+                 metrics: PipelineMetrics = None,
                  verbose=False):
+        """
+        :param outputs: (img_queue, TransportStats, RawFrameSlots) for every display grabbed by `source`, in the
+                        order of `source.grab_all()`. Without raw slots the screenshots are pickled through
+                        the queue.
+        """
         multiprocessing.Process.__init__(self)
         # Communication
-        self.img_queue = img_queue
+        self.outputs = outputs
         self.conn = rec_conn
-        self.shot_conn = shot_conn
+        self.pacing_stats = pacing_stats
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
+        self.unresponsive = set()  # Indices of the outputs whose converter stopped taking tasks
 
         # Capture info
         self.interval = interval
-        self.display = display
+        self.source = source
 
         # Logging
         self.verbose = verbose
 
+    @staticmethod
+    def _put(output, sct_img, timestamp):
+        """
+        Hand the screenshot over to the converter. Drop it if the converter is not keeping up.
+        """
+        img_queue, stats, raw_slots = output
+        if raw_slots is None:
+            try:
+                img_queue.put_nowait((sct_img.detached(), timestamp))
+            except queue.Full:
+                stats.increment(TransportStats.DROPPED)
+                return
+        else:
+            slot = raw_slots.acquire()
+            if slot is None:
+                stats.increment(TransportStats.DROPPED)
+                return
+            raw_slots.write(slot, sct_img.raw)
+            raw_slots.publish_latest(slot, sct_img.size, timestamp)
+            img_queue.put((slot, timestamp, sct_img.size))
+        stats.increment(TransportStats.GRABBED)
+
+    def _broadcast(self, item):
+        """
+        Pass a task on to every converter, after the frames grabbed so far. A converter that doesn't take it in
+        time has died with its queue full, it's skipped from then on.
+        """
+        for i, (img_queue, _, _) in enumerate(self.outputs):
+            if i in self.unresponsive:
+                continue
+            try:
+                img_queue.put(item, timeout=values.TASK_TIMEOUT)
+            except queue.Full:
+                self.unresponsive.add(i)
+                if self.verbose:
+                    print(f"[Capture/Record] Converter {i} not responding, task dropped")
+
+    def _reconfigure(self, source, changes):
+        """
+        Apply the recorder's part of new settings and pass them on to the converters
+        :return: source to grab from
+        """
+        if 'fps' in changes:
+            self.interval = pow(10, 9) / changes['fps']
+        if 'source' in changes:
+            source.close()
+            source = changes.pop('source')
+            source.open()
+            self.conn.send(source.monitors())
+        self._broadcast((values.TASK_CONFIG, changes))
+        return source
+
     def run(self):
+        """
+        The process is started paused and is kept between recordings - TASK_RESUME starts grabbing frames,
+        TASK_PAUSE stops it and TASK_KILL ends the process
+        """
         if self.verbose:
             print("[Capture/Record] Recording process running...")
-        # recorder = dxcam.create(output_color="BGR")
-        # recorder.start(target_fps=60, video_mode=True)
-        with mss.mss() as sct:
-            mon = sct.monitors[self.display]
-            self.conn.send(mon)
-            previous_shot = time.perf_counter_ns()
-            while "Recording":
-                if self.conn.poll():
-                    task = self.conn.recv()
-                    if task == values.TASK_KILL:
-                        self.img_queue.put(None)
-                        break
-                    if task == values.TASK_SHOT:
-                        self.shot_conn.send(sct.grab(mon))
+        source = self.source
+        source.open()
+        self.conn.send(source.monitors())
+        paused = True
+        pacer = None
+        shots = 0
+        while "Recording":
+            if self.conn.poll(None if paused else 0):
+                task = self.conn.recv()
+                if task == values.TASK_KILL:
+                    self._broadcast(None)
+                    break
+                if task == values.TASK_PAUSE and not paused:
+                    paused = True
+                    self.pacing_stats.publish(pacer.stats())
+                    self._broadcast((values.TASK_PAUSE, None))
+                    if self.verbose:
+                        print(f"[Capture/Record] Paused ({[stats.get() for _, stats, _ in self.outputs]}, "
+                              f"{pacer.stats()})")
+                elif task == values.TASK_RESUME and paused:
+                    paused = False
+                    pacer = FramePacer(self.interval)
+                    shots = 0
+                elif isinstance(task, tuple) and task[0] == values.TASK_CONFIG:
+                    source = self._reconfigure(source, task[1])
+                    if pacer is not None:
+                        pacer = FramePacer(self.interval)
+                continue
+
+            # Wait to align the frames, all displays share the timestamp
+            timestamp = pacer.wait()
+            for output, sct_img in zip(self.outputs, source.grab_all()):
+                self._put(output, sct_img, timestamp)
+            self.metrics.grab_seconds.observe((time.perf_counter_ns() - timestamp) / pow(10, 9))
+            # print("[Capture/Record] Put photo")
+
+            shots += 1
+            if shots % max(1, round(pow(10, 9) / self.interval)) == 0:  # About once a second
+                self.pacing_stats.publish(pacer.stats())
+
+        source.close()
+        for _, _, raw_slots in self.outputs:
+            if raw_slots is not None:
+                raw_slots.close()
+        if self.verbose:
+            print("[Capture/Record] Recording process finishing...")
 
-                # Wait to align the frames
-                while time.perf_counter_ns() < previous_shot + self.interval:
-                    pass
 
-                previous_shot = time.perf_counter_ns()
-                sct_img = sct.grab(mon)
+_worker_slots: RawFrameSlots = None  # Raw frame slots attached in an encoder pool worker
 
-                self.img_queue.put(sct_img)
-                # print("[Capture/Record] Put photo")
 
-        if self.verbose:
-            print("[Capture/Record] Recording process finishing...")
+def _init_encode_worker(raw_slots):
+    global _worker_slots
+    _worker_slots = raw_slots
+
+
+def _encode_in_worker(item, format_, quality, resolution, previous):
+    """
+    :return: (frame kind, encoded frame bytes, encoding time in ns)
+    """
+    start = time.perf_counter_ns()
+    kind, data = encode_item(item, _worker_slots, format_, quality, resolution, previous)
+    return kind, data, time.perf_counter_ns() - start
+
+
+def _item_array(item, raw_slots):
+    """
+    :param item: (RawFrame, timestamp) or (slot, timestamp, size) if raw frames are passed through shared memory
+    :return: numpy array of shape (height, width, 4) with the raw BGRA frame
+    """
+    if raw_slots is None:
+        sct_img, _ = item
+        width, height = sct_img.size
+        return np.frombuffer(sct_img.raw, dtype=np.uint8).reshape((height, width, 4))
+    slot, _, size = item
+    return raw_slots.array(slot, size)
+
+
+def encode_item(item, raw_slots, format_, quality, resolution=None, previous=None):
+    """
+    Encode a single item taken from the recorder's queue. The raw slots are not released here.
+    :param item: (RawFrame, timestamp) or (slot, timestamp, size) if raw frames are passed through shared memory
+    :param raw_slots: RawFrameSlots the item refers to, None for screenshots
+    :param previous: item of the previous frame to store only the changes from, None for a keyframe
+    :return: (frame kind, encoded frame bytes)
+    """
+    current = _item_array(item, raw_slots)
+    if resolution is not None:
+        current = downscale(current, resolution)
+
+    if previous is not None:
+        before = _item_array(previous, raw_slots)
+        if resolution is not None:
+            before = downscale(before, resolution)
+        if before.shape == current.shape:
+            data = encode_delta(current, before, quality)
+            if data == b"":
+                return values.FRAME_REPEAT, data
+            if data is not None:
+                return values.FRAME_DELTA, data
+
+    frame = Frame.from_raw(current, (current.shape[1], current.shape[0]), format_, quality)
+    return values.FRAME_KEY, frame.buffered_img.getvalue()
 
 
 class ConvertProcess(multiprocessing.Process):
     def __init__(self,
                  img_queue,
-                 buffered_frames,
-                 trim_send,
+                 buffer: FrameBuffer,
                  length,
                  fps,
                  format_,
                  quality,
+                 stats: TransportStats,
+                 raw_slots: RawFrameSlots = None,
                  resolution=None,
+                 encoders=values.DEFAULT_ENCODERS,
+                 buffer_mode=values.DEFAULT_BUFFER_MODE,
+                 metrics: PipelineMetrics = None,
+                 conn=None,
                  verbose=False):
         multiprocessing.Process.__init__(self)
         # Communication
         self.img_queue = img_queue
-        self.frames = buffered_frames
-        self.trim_signal = trim_send
+        self.buffer = buffer
+        self.conn = conn  # Acknowledges pauses and new settings, once the frames before them are stored
+        self.raw_slots = raw_slots
+        self.stats = stats
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
 
         # Frame format / quality
         self.length = length
@@ -254,74 +758,693 @@ class ConvertProcess(multiprocessing.Process):
         self.format_ = format_
         self.quality = quality
         self.resolution = resolution
+        self.buffer_mode = buffer_mode  # BUFFER_DELTA - store only the tiles that changed since the last frame
+
+        # Number of encoding processes, 0 - pick automatically
+        self.encoders = encoders
+
+        # Memory budget state, quality and frame rate are lowered if a replay wouldn't fit in the buffer
+        self.current_quality = quality
+        self.frame_step = 1  # Encode every n-th frame, the rest repeat the previous one
+        self.frame_bytes = None  # Moving average of the stored frame size
+        self.smoothing = 2 / (fps + 1)  # Average over about a second
+
+        # Delta frames state
+        self.keyframe_every = max(1, round(values.DELTA_KEYFRAME_INTERVAL * fps))
+        self.since_key = 0
+        self.last_submitted = None  # Item the next delta is computed against
+        self.last_stored = None  # Item whose raw slot is kept for the next delta
+        self.broken_chain = False  # A frame was dropped - deltas are useless until the next keyframe
 
         # Logging
         self.verbose = verbose
 
+    def _previous_for(self, item):
+        """
+        :return: item to encode the changes from or None if a keyframe is due
+        """
+        previous = self.last_submitted
+        self.last_submitted = item
+        if self.buffer_mode != values.BUFFER_DELTA or previous is None or self.broken_chain or \
+                self.since_key + self.frame_step >= self.keyframe_every:
+            self.since_key = 0
+            return None
+        self.since_key += self.frame_step
+        return previous
+
+    def _adjust_to_budget(self):
+        """
+        Project the size of a whole replay from the recent frame sizes. Lower the quality and then the frame
+        rate if it would overflow the buffer, restore them once there is room again. A replay gets only
+        1 / BUFFER_HEADROOM of the buffer, the rest keeps the recording going while an export pins older frames.
+        """
+        projected = self.frame_bytes * self.length * self.fps * values.BUFFER_HEADROOM / self.buffer.data_size
+        if projected > values.BUDGET_HIGH:
+            if self.current_quality > values.MIN_QUALITY:
+                self.current_quality = max(values.MIN_QUALITY, self.current_quality - values.BUDGET_QUALITY_STEP)
+            elif self.frame_step < values.MAX_FRAME_STEP:
+                self.frame_step += 1
+            else:
+                return
+        elif projected < values.BUDGET_LOW:
+            if self.frame_step > 1 and projected * self.frame_step / (self.frame_step - 1) < values.BUDGET_LOW:
+                self.frame_step -= 1
+            elif self.frame_step == 1 and self.current_quality < self.quality:
+                self.current_quality = min(self.quality, self.current_quality + values.BUDGET_QUALITY_STEP)
+            else:
+                return
+        else:
+            return
+
+        self.stats.set(TransportStats.QUALITY, self.current_quality)
+        self.stats.set(TransportStats.FRAME_STEP, self.frame_step)
+        if self.verbose:
+            print(f"[Capture/Convert] Replay projected to use {projected:.0%} of its budget - "
+                  f"quality={self.current_quality}, frame_step={self.frame_step}")
+
+    def _store(self, item, kind, data, encode_ns=None, skipped=False):
+        """
+        Publish an encoded frame and hand back raw slots no longer needed
+        :param encode_ns: time it took to encode the frame
+        :param skipped: the frame wasn't encoded to save memory, it can't be used for the next delta
+        """
+        self.stats.increment(TransportStats.CONVERTED)
+        if not skipped:
+            self.metrics.encode_seconds.observe(encode_ns / pow(10, 9))
+            self.metrics.frame_bytes.observe(len(data))
+        self.frame_bytes = len(data) if self.frame_bytes is None else \
+            self.frame_bytes + self.smoothing * (len(data) - self.frame_bytes)
+        if self.broken_chain and kind != values.FRAME_KEY:
+            stored = False
+        else:
+            stored = self.buffer.append(data, kind, item[1])
+            self.broken_chain = not stored and self.buffer_mode == values.BUFFER_DELTA
+        if not stored:
+            self.metrics.buffer_dropped.increment()
+            if self.verbose:
+                print("[Capture/Convert] Frame dropped - too big or the buffer is held by exports")
+
+        if self.raw_slots is not None:
+            if self.buffer_mode == values.BUFFER_DELTA and not skipped:
+                # The raw frame is needed until the next frame is encoded
+                item, self.last_stored = self.last_stored, item
+            if item is not None:
+                self.raw_slots.release(item[0])
+
+    def _reset_chain(self):
+        """
+        Start over with a keyframe, e.g. after a pause or when the frame size changes
+        """
+        if self.raw_slots is not None and self.last_stored is not None:
+            self.raw_slots.release(self.last_stored[0])
+        self.last_stored = None
+        self.last_submitted = None
+        self.since_key = 0
+        self.broken_chain = False
+
+    def _reconfigure(self, changes):
+        """
+        Apply new settings sent through the recorder. All frames before them have been stored.
+        :param changes: dict with any of LIVE_CONFIG and 'clear' - the buffered frames have to be dropped
+        """
+        if 'fps' in changes:
+            self.fps = changes['fps']
+            self.smoothing = 2 / (self.fps + 1)
+            self.keyframe_every = max(1, round(values.DELTA_KEYFRAME_INTERVAL * self.fps))
+        if 'quality' in changes:
+            self.quality = self.current_quality = changes['quality']
+            self.stats.set(TransportStats.QUALITY, self.current_quality)
+        if 'resolution' in changes:
+            self.resolution = changes['resolution']
+        if changes.get('clear'):
+            self._reset_chain()
+            self.buffer.clear()
+        if self.verbose:
+            print(f"[Capture/Convert] New settings {changes}")
+
+    def _pick_encoders(self, encode_times):
+        """
+        Number of workers needed to keep up with the recorder, based on the measured encoding time of a frame
+        """
+        encode_time = sorted(encode_times)[len(encode_times) // 2]
+        needed = math.ceil(encode_time * self.fps * values.ENCODER_HEADROOM / pow(10, 9))
+        return max(1, min(needed, values.MAX_ENCODERS, (os.cpu_count() or 2) - 1))
+
+    def _make_pool(self, workers):
+        if self.verbose:
+            print(f"[Capture/Convert] Starting {workers} encoding workers")
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_encode_worker, initargs=(self.raw_slots,))
+
     def run(self):
-        cnt = 0
         if self.verbose:
             print(f"[Capture/Convert] Convert("
                   f"length={self.length}, "
                   f"fps={self.fps}, "
                   f"format_={self.format_}, "
                   f"quality={self.quality}, "
-                  f"resolution={self.resolution}, ")
+                  f"resolution={self.resolution}, "
+                  f"transport={values.TRANSPORT_QUEUE if self.raw_slots is None else values.TRANSPORT_SHM}, "
+                  f"encoders={self.encoders}, "
+                  f"buffer_mode={self.buffer_mode})")
             print("[Capture/Convert] Converting process running...")
-        while "There are screenshots":
-            if cnt >= self.length * self.fps * 1.1:
-                cnt = self.length * self.fps
-                self.trim_signal.send(values.TASK_TRIM)
 
-            sct_img = self.img_queue.get()
+        workers = self.encoders
+        pool = self._make_pool(workers) if workers > 1 else None
+        encode_times = []  # Used to pick the number of workers
+        pending = deque()  # (item, future, skipped) in the order the frames were grabbed
+        self.stats.set(TransportStats.QUALITY, self.current_quality)
+        self.stats.set(TransportStats.FRAME_STEP, self.frame_step)
+        seq = 0
+        while "There are screenshots":
+            try:
+                # Don't block while there are encoded frames waiting to be stored
+                item = self.img_queue.get(timeout=1 / self.fps if pending else None)
+                if item is None:
+                    break
+            except queue.Empty:
+                item = None
+            if item is not None and isinstance(item[0], str):
+                # Pause or new settings from the recorder - finish the frames grabbed before
+                task, changes = item
+                for pending_item, future, skipped in pending:
+                    self._store(pending_item, *future.result(), skipped=skipped)
+                pending.clear()
+                if task == values.TASK_PAUSE:
+                    # The next recording starts from scratch, the recorder is idle until it's resumed. A
+                    # persistent buffer keeps the replay across pauses and restarts.
+                    self._reset_chain()
+                    if not self.buffer.persistent:
+                        self.buffer.clear()
+                    self.buffer.flush()
+                    self.current_quality, self.frame_step, self.frame_bytes = self.quality, 1, None
+                    self.stats.reset()
+                    self.stats.set(TransportStats.QUALITY, self.current_quality)
+                    self.stats.set(TransportStats.FRAME_STEP, self.frame_step)
+                else:
+                    self._reconfigure(changes)
+                if self.conn is not None:
+                    self.conn.send(task)
+                continue
             # print("[Capture/Convert] Got photo")
-            if sct_img is None:
-                self.trim_signal.send(values.TASK_KILL)
-                break
-            frame = Frame(sct_img, self.format_, self.quality, self.resolution)
-            self.frames.append(frame)
-            cnt += 1
-            # print(f"[Capture/Convert] CNT={cnt}")
+            if item is not None:
+                self.metrics.queue_wait_seconds.observe((time.perf_counter_ns() - item[1]) / pow(10, 9))
+
+            skipped = item is not None and seq % self.frame_step != 0
+            if skipped and pool is None:
+                self._store(item, values.FRAME_REPEAT, b"", skipped=True)
+            elif skipped:
+                future = Future()
+                future.set_result((values.FRAME_REPEAT, b"", None))
+                pending.append((item, future, True))
+            elif item is not None and pool is None:
+                start = time.perf_counter_ns()
+                kind, data = encode_item(item, self.raw_slots, self.format_, self.current_quality, self.resolution,
+                                         self._previous_for(item))
+                encode_ns = time.perf_counter_ns() - start
+                self._store(item, kind, data, encode_ns)
+                if workers == 0:
+                    encode_times.append(encode_ns)
+                    if len(encode_times) == values.ENCODER_PROBE_FRAMES:
+                        workers = self._pick_encoders(encode_times)
+                        pool = self._make_pool(workers) if workers > 1 else None
+            elif item is not None:
+                future = pool.submit(_encode_in_worker, item, self.format_, self.current_quality, self.resolution,
+                                     self._previous_for(item))
+                pending.append((item, future, False))
+            if item is not None:
+                seq += 1
+                if seq % max(1, int(self.fps)) == 0 and self.frame_bytes is not None:
+                    self._adjust_to_budget()
+                    self.buffer.flush()
+
+            # Store encoded frames in order, wait for the oldest one if too many are in flight
+            while pending and (pending[0][1].done() or len(pending) > 2 * workers):
+                item, future, skipped = pending.popleft()
+                self._store(item, *future.result(), skipped=skipped)
+
+        for item, future, skipped in pending:
+            self._store(item, *future.result(), skipped=skipped)
+        if pool is not None:
+            pool.shutdown()
+        self.buffer.close()
+        if self.raw_slots is not None:
+            self.raw_slots.close()
         if self.verbose:
-            print("[Capture/Convert] Converting process finishing...")
+            print(f"[Capture/Convert] Converting process finishing ({seq} frames, {workers} encoders)...")
+
 
+class SegmentProcess(multiprocessing.Process):
+    """
+    Converter of the BUFFER_SEGMENTS mode: pipes the raw frames to ffmpeg, which encodes them into the rolling
+    segments of a SegmentStore. Scaling and encoding run in ffmpeg on all cores, so the work is spread evenly
+    over the recording and an export is only a copy of the newest segments.
+    """
 
-class TrimProcess(multiprocessing.Process):
     def __init__(self,
-                 buffered_frames,
-                 trim_recv,
-                 length,
+                 img_queue,
+                 store: SegmentStore,
                  fps,
+                 quality,
+                 stats: TransportStats,
+                 raw_slots: RawFrameSlots = None,
+                 resolution=None,
+                 metrics: PipelineMetrics = None,
+                 conn=None,
                  verbose=False):
         multiprocessing.Process.__init__(self)
         # Communication
-        self.buffered_frames = buffered_frames
-        self.trim_recv = trim_recv
+        self.img_queue = img_queue
+        self.store = store
+        self.conn = conn  # Acknowledges pauses and new settings, once the frames before them are written
+        self.raw_slots = raw_slots
+        self.stats = stats
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
 
-        # Trimming info
-        self.length = length
+        # Video settings
         self.fps = fps
+        self.quality = quality
+        self.resolution = resolution
 
         # Logging
         self.verbose = verbose
 
+    def _restart(self, encoder, size=None):
+        """
+        Finish the current segments and drop them, the video is started over with the current settings
+        :param size: (width, height) of the raw frames, None - don't start a new encoder yet
+        :return: new SegmentEncoder or None
+        """
+        if encoder is not None:
+            encoder.close()
+        self.store.clear()
+        if size is None:
+            return None
+        if self.verbose:
+            print(f"[Capture/Segments] Encoding {size} frames into {self.store.directory}")
+        return SegmentEncoder(self.store, size, scaled_size(size, self.resolution), self.fps, self.quality)
+
     def run(self):
         if self.verbose:
-            print("[Capture/Trim] Trimming process running...")
-        while "Working":
-            if self.trim_recv.poll():
-                task = self.trim_recv.recv()
-                if task == values.TASK_KILL:
-                    break
-                elif task == values.TASK_TRIM:
-                    if self.verbose:
-                        print(f"[Capture/Trim] Trimming buffered frames (len={len(self.buffered_frames)})")
-                    del self.buffered_frames[:-self.length * self.fps]
-                    if self.verbose:
-                        print(f"[Capture/Trim] After trim (len={len(self.buffered_frames)})")
+            print("[Capture/Segments] Segment encoding process running...")
+        self.stats.set(TransportStats.QUALITY, self.quality)
+        self.stats.set(TransportStats.FRAME_STEP, 1)
+        encoder = self._restart(None)
+        while "There are screenshots":
+            item = self.img_queue.get()
+            if item is None:
+                break
+            if isinstance(item[0], str):
+                # Pause or new settings from the recorder, the segments written so far are dropped
+                task, changes = item
+                encoder = self._restart(encoder)
+                if task == values.TASK_PAUSE:
+                    self.stats.reset()
+                else:
+                    self.fps = changes.get('fps', self.fps)
+                    self.quality = changes.get('quality', self.quality)
+                    self.resolution = changes.get('resolution', self.resolution)
+                self.stats.set(TransportStats.QUALITY, self.quality)
+                self.stats.set(TransportStats.FRAME_STEP, 1)
+                if self.conn is not None:
+                    self.conn.send(task)
+                continue
+
+            self.metrics.queue_wait_seconds.observe((time.perf_counter_ns() - item[1]) / pow(10, 9))
+            current = _item_array(item, self.raw_slots)
+            size = (current.shape[1], current.shape[0])
+            if encoder is None or encoder.size != size:
+                encoder = self._restart(encoder, size)
+            start = time.perf_counter_ns()
+            try:
+                for _ in range(encoder.ticks(item[1])):
+                    encoder.write(current.data)
+            except OSError as e:
+                if self.verbose:
+                    print(f"[Capture/Segments] ffmpeg stopped ({e}), starting over")
+                encoder = self._restart(encoder)
+            self.metrics.encode_seconds.observe((time.perf_counter_ns() - start) / pow(10, 9))
+            self.stats.increment(TransportStats.CONVERTED)
+            if self.raw_slots is not None:
+                self.raw_slots.release(item[0])
+
+        if encoder is not None:
+            encoder.close()
+        if self.raw_slots is not None:
+            self.raw_slots.close()
+        if self.verbose:
+            print("[Capture/Segments] Segment encoding process finishing...")
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def composite_layout(monitors, resolution=None):
+    """
+    Place displays next to each other the way they are arranged on the desktop
+    :param monitors: monitor dicts (left, top, width, height) of the displays
+    :param resolution: (width, height) the whole picture is downscaled to fit, None - native size
+    :return: ((width, height) of the picture, [(x, y, width, height) of every display in the picture])
+    """
+    left = min(mon['left'] for mon in monitors)
+    top = min(mon['top'] for mon in monitors)
+    width = max(mon['left'] + mon['width'] for mon in monitors) - left
+    height = max(mon['top'] + mon['height'] for mon in monitors) - top
+    size = scaled_size((width, height), resolution)
+    size = (max(2, size[0] // 2 * 2), max(2, size[1] // 2 * 2))  # Video codecs expect even dimensions
+    ratio = size[0] / width
+    placements = []
+    for mon in monitors:
+        x, y = round((mon['left'] - left) * ratio), round((mon['top'] - top) * ratio)
+        placements.append((x, y, min(round(mon['width'] * ratio), size[0] - x),
+                           min(round(mon['height'] * ratio), size[1] - y)))
+    return size, placements
+
+
+class ExportProcess(multiprocessing.Process):
+    def __init__(self,
+                 job_queue,
+                 event_queue,
+                 cancel_queue,
+                 buffers: list,
+                 metrics: PipelineMetrics = None,
+                 verbose=False):
+        """
+        :param buffers: FrameBuffer of every captured display
+        """
+        multiprocessing.Process.__init__(self)
+        # Communication
+        self.job_queue = job_queue
+        self.event_queue = event_queue
+        self.cancel_queue = cancel_queue
+        self.buffers = buffers
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
+
+        self.cancelled = set()
 
+        # Logging
+        self.verbose = verbose
+
+    def _is_cancelled(self, job_id):
+        while True:
+            try:
+                self.cancelled.add(self.cancel_queue.get_nowait())
+            except queue.Empty:
+                break
+        return job_id in self.cancelled
+
+    def _frames(self, job_id, stream, snapshot, format_, screen_size, progress=True):
+        """
+        Frames of the job pulled lazily from the buffer, reporting progress and checking for cancellation. The
+        frames before the snapshot's first one, back to its keyframe, are only there to be decoded.
+        :param snapshot: (pin, first, end) from FrameBuffer.snapshot
+        :param progress: False - don't report progress, another display of the job does
+        """
+        pin, first, end = snapshot
+        buffer = self.buffers[stream]
+        lead = min(buffer.pinned(pin), first)
+        start = buffer.timestamp(first)
+        total = end - lead
+        for done, (kind, data, timestamp) in enumerate(buffer.iter_frames(lead, end)):
+            if progress and done % values.EXPORT_PROGRESS_EVERY == 0:
+                if self._is_cancelled(job_id):
+                    raise ExportCancelled()
+                self.event_queue.put((values.EXPORT_PROGRESS, job_id, done, total))
+            self.metrics.export_frames.increment()
+            lead_in = start is not None and timestamp < start
+            yield Frame(data, format_, screen_size, kind, timestamp, lead_in)
+
+    @staticmethod
+    def _paste(canvas, img, placement):
+        x, y, width, height = placement
+        if img.shape[1] != width or img.shape[0] != height:
+            img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+        canvas[y:y + height, x:x + width] = img
+
+    def _composite(self, job_id, parts, format_, size):
+        """
+        Frames of several displays put together. The displays share the capture clock, every frame of the
+        first display is combined with the newest frames of the others captured up to the same moment.
+        """
+        canvas = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        streams = [decode_frames(self._frames(job_id, stream, snapshot, format_, frame_size, progress=i == 0))
+                   for i, (stream, snapshot, frame_size, _) in enumerate(parts)]
+        upcoming = [next(frames, None) for frames in streams[1:]]
+        for timestamp, img in streams[0]:
+            self._paste(canvas, img, parts[0][3])
+            for i, frames in enumerate(streams[1:]):
+                while upcoming[i] is not None and (timestamp is None or upcoming[i][0] <= timestamp):
+                    self._paste(canvas, upcoming[i][1], parts[i + 1][3])
+                    upcoming[i] = next(frames, None)
+            _, jpeg = cv2.imencode(".jpg", canvas, [cv2.IMWRITE_JPEG_QUALITY, values.COMPOSITE_QUALITY])
+            yield Frame(jpeg.tobytes(), format_, size, values.FRAME_KEY, timestamp)
+
+    def _join(self, job_id, video_encoder, snapshot: SegmentSnapshot):
+        """
+        Put continuously encoded segments together, they are always written as MP4
+        """
+        self.event_queue.put((values.EXPORT_PROGRESS, job_id, 0, len(snapshot.paths)))
+        saver = video_encoder.file_saver
+        output_path = FileSaver(saver.directory, saver.file_prefix, values.SEGMENT_EXTENSION).get_free_path()
+        try:
+            return snapshot.join(output_path)
+        except BaseException:
+            VideoEncoder._discard(output_path)
+            raise
+
+    def _release(self, parts):
+        if isinstance(parts, SegmentSnapshot):
+            parts.release()
+            return
+        for stream, (pin, _, _), _, _ in parts:
+            self.buffers[stream].release(pin)
+
+    @staticmethod
+    def _describe(parts):
+        if isinstance(parts, SegmentSnapshot):
+            return f"{len(parts.paths)} segments"
+        return f"{[end - first for _, (_, first, end), _, _ in parts]} frames"
+
+    def run(self):
+        FileSaver.reset()
         if self.verbose:
-            print("[Capture/Trim] Trimming process finishing...")
+            print("[Capture/Export] Exporting process running...")
+        while "There are jobs":
+            job = self.job_queue.get()
+            if job is None:
+                break
+            job_id, video_encoder, parts, format_, size = job
+            if self._is_cancelled(job_id):
+                self._release(parts)
+                self.event_queue.put((values.EXPORT_CANCELLED, job_id))
+                continue
+
+            if self.verbose:
+                print(f"[Capture/Export] Exporting {self._describe(parts)} (job={job_id})")
+            start = time.perf_counter_ns()
+            try:
+                if isinstance(parts, SegmentSnapshot):
+                    path = self._join(job_id, video_encoder, parts)
+                else:
+                    if len(parts) == 1:
+                        stream, snapshot, frame_size, _ = parts[0]
+                        frames = self._frames(job_id, stream, snapshot, format_, frame_size)
+                    else:
+                        frames = self._composite(job_id, parts, format_, size)
+                    path = video_encoder.encode(frames, size)
+            except ExportCancelled:
+                self.event_queue.put((values.EXPORT_CANCELLED, job_id))
+            except Exception as e:
+                self.metrics.exports_failed.increment()
+                self.event_queue.put((values.EXPORT_FAILED, job_id, repr(e)))
+            else:
+                self.metrics.export_seconds.observe((time.perf_counter_ns() - start) / pow(10, 9))
+                self.event_queue.put((values.EXPORT_DONE, job_id, path))
+            finally:
+                self._release(parts)
+            self.cancelled.discard(job_id)
+
+        for buffer in self.buffers:
+            if buffer is not None:
+                buffer.close()
+        self.event_queue.put(None)
+        if self.verbose:
+            print("[Capture/Export] Exporting process finishing...")
+
+
+class ExportService:
+    """
+    Runs video exports one after another in a separate process, so neither the GUI/hotkey thread nor the
+    recording is held up. Events are passed to `listener(event, job_id, *args)` from a background thread:
+    EXPORT_PROGRESS (done, total), EXPORT_DONE (path), EXPORT_FAILED (error) and EXPORT_CANCELLED.
+    """
+
+    def __init__(self,
+                 buffers: list,
+                 listener=None,
+                 metrics: PipelineMetrics = None,
+                 verbose=False):
+        """
+        :param buffers: FrameBuffer of every captured display
+        """
+        self.buffers = buffers
+        self.listener = listener
+        self.metrics = metrics
+        self.verbose = verbose
+
+        self.job_queue = Queue(maxsize=values.EXPORT_QUEUE_SIZE)
+        self.event_queue = Queue()
+        self.cancel_queue = Queue()
+        self.process = None
+        self.events_thread = None
+        self.last_job_id = 0
+        # Segments are copied off the calling (hotkey/GUI) thread, one export after another
+        self.copy_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="segments")
+
+    def start(self):
+        if self.process is not None:
+            return
+        self.process = ExportProcess(self.job_queue, self.event_queue, self.cancel_queue, self.buffers,
+                                     self.metrics, verbose=self.verbose)
+        self.process.start()
+        self.events_thread = threading.Thread(target=self._dispatch_events, daemon=True)
+        self.events_thread.start()
+
+    def _dispatch_events(self):
+        while (event := self.event_queue.get()) is not None:
+            if self.verbose:
+                print(f"[Capture/Export] {event}")
+            if self.listener is not None:
+                self.listener(*event)
+
+    def _release(self, parts):
+        for stream, (pin, _, _), _, _ in parts:
+            self.buffers[stream].release(pin)
+
+    def submit(self, video_encoder: VideoEncoder, duration, format_, parts, size):
+        """
+        Snapshot the newest frames and queue their export. The live buffers are left untouched, so exports may
+        overlap.
+        :param duration: seconds of the newest frames to export, measured with their capture timestamps
+        :param parts: [(display index, (width, height) of its frames, (x, y, width, height) in the video)],
+                      several displays are composited into one video
+        :param size: (width, height) of the video
+        :return: job id or None if too many exports are queued
+        """
+        self.start()
+        snapshots = []
+        for stream, frame_size, placement in parts:
+            snapshot = self.buffers[stream].snapshot(duration=int(duration * pow(10, 9)))
+            if snapshot is None:
+                self._release(snapshots)
+                return None
+            snapshots.append((stream, snapshot, frame_size, placement))
+        self.last_job_id += 1
+        try:
+            self.job_queue.put_nowait((self.last_job_id, video_encoder, snapshots, format_, size))
+        except queue.Full:
+            self._release(snapshots)
+            return None
+        if self.verbose:
+            print(f"[Capture/Export] Queued export of {[end - first for _, (_, first, end), _, _ in snapshots]} "
+                  f"frames (job={self.last_job_id})")
+        return self.last_job_id
+
+    def submit_segments(self, video_encoder: VideoEncoder, duration, store: SegmentStore):
+        """
+        Queue joining the newest continuously encoded segments. They are copied first, on a background thread,
+        so ffmpeg can keep overwriting the oldest ones.
+        :param duration: seconds of the newest video to export, rounded up to whole segments
+        :return: job id, None if too many exports are queued, False if nothing was recorded yet
+        """
+        self.start()
+        if not store.recorded():
+            return False
+        if self.job_queue.full():
+            return None
+        self.last_job_id += 1
+        self.copy_executor.submit(self._queue_segments, self.last_job_id, video_encoder, duration, store)
+        return self.last_job_id
+
+    def _queue_segments(self, job_id, video_encoder, duration, store: SegmentStore):
+        snapshot = store.snapshot(duration)
+        if snapshot is None:
+            self.event_queue.put((values.EXPORT_FAILED, job_id, "no segments to export"))
+            return
+        self.job_queue.put((job_id, video_encoder, snapshot, None, None))
+        if self.verbose:
+            print(f"[Capture/Export] Queued export of {len(snapshot.paths)} segments (job={job_id})")
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running export. The partially written file is removed.
+        """
+        self.cancel_queue.put(job_id)
+
+    def stop(self):
+        """
+        Finish the queued exports and stop the exporting process
+        """
+        if self.process is None:
+            return
+        self.copy_executor.shutdown()  # Segments being copied are queued before the end
+        self.job_queue.put(None)
+        self.process.join()
+        self.events_thread.join()
+        self.process = None
+
+
+class DisplayStream:
+    """
+    Part of the pipeline owned by one captured display: its raw frames go through their own queue and
+    converter into their own frame buffer (or segments). The recorder, its clock and the exports are shared
+    by all displays.
+    """
+
+    def __init__(self,
+                 display,
+                 buffer: FrameBuffer,
+                 n_raw_slots,
+                 raw_slot_size=None,
+                 metrics: PipelineMetrics = None,
+                 segments: SegmentStore = None):
+        """
+        :param buffer: None when the video is encoded continuously into `segments`
+        :param raw_slot_size: bytes of the largest raw frame, None - pass the frames through the queue instead
+        """
+        self.display = display
+        self.buffer = buffer
+        self.segments = segments
+        self.img_queue = Queue(maxsize=n_raw_slots)
+        self.stats = TransportStats()
+        self.raw_slots = RawFrameSlots(n_raw_slots, raw_slot_size, Queue()) if raw_slot_size else None
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
+        self.conv_recv, self.conv_send = Pipe(duplex=False)
+        self.conv_process = None
+
+    def output(self):
+        """
+        :return: what the recorder needs to hand the frames of this display over
+        """
+        return self.img_queue, self.stats, self.raw_slots
+
+    def usage(self, fps):
+        """
+        :return: (bytes used, buffered seconds, size of the buffer in bytes - 0 for segments)
+        """
+        if self.segments is not None:
+            used, seconds = self.segments.used_bytes()
+            return used, seconds, 0
+        used, frames = self.buffer.used_bytes()
+        return used, frames / fps, self.buffer.data_size
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.unlink()
+        if self.segments is not None:
+            self.segments.clear()
+        if self.raw_slots is not None:
+            self.raw_slots.unlink()
 
 
 class Capture:
@@ -329,20 +1452,55 @@ class Capture:
                  video_encoder: VideoEncoder,
                  photo_encoder: PhotoEncoder,
                  display=1,
-                 resolution=(1920, 1080),
+                 resolution=None,
                  quality=80,
                  fps=20,
                  length=10,
+                 ram_usage=values.DEFAULT_RAM_USAGE,
+                 transport=values.DEFAULT_TRANSPORT,
+                 encoders=values.DEFAULT_ENCODERS,
+                 buffer_mode=values.DEFAULT_BUFFER_MODE,
+                 storage=values.DEFAULT_STORAGE,
+                 disk_usage=values.DEFAULT_DISK_USAGE,
+                 buffer_file=values.DEFAULT_BUFFER_FILE,
+                 source=values.DEFAULT_SOURCE,
+                 replay_file=None,
+                 metrics_port=values.DEFAULT_METRICS_PORT,
+                 displays=None,
+                 region=None,
+                 window=None,
                  with_sound: bool = False,
+                 export_listener=None,
                  verbose: bool = False):
         # Recording options
         self.display = display
-        self.resolution = resolution
+        self.displays = list(displays) if displays else [display]  # all recorded at once, `display` comes first
+        if self.display in self.displays:
+            self.displays.remove(self.display)
+        self.displays.insert(0, self.display)
+        self.resolution = resolution  # frames are downscaled to fit, None - keep the monitor resolution
         self.quality = quality  # quality of the saved frames (increase for more ram usage)
         self.format_ = values.CAPTURE_JPEG  # todo add new extensions
         self.fps = fps
         self.interval = (1 / self.fps) * pow(10, 9)  # interval between frames in nanoseconds
         self.length = length
+        self.ram_usage = ram_usage  # size of the frame buffers in bytes, split between the displays
+        self.transport = transport
+        self.encoders = encoders  # number of frame encoding processes, 0 - pick automatically
+        self.buffer_mode = buffer_mode
+        if self.buffer_mode == values.BUFFER_SEGMENTS and not segments_available():
+            if verbose:
+                print("[Capture] ffmpeg not found, frames are buffered instead of segments")
+            self.buffer_mode = values.BUFFER_FULL
+        self.storage = storage  # STORAGE_DISK / STORAGE_PERSISTENT - keep the encoded frames in `buffer_file`
+        self.disk_usage = disk_usage  # size of the buffer files in bytes, split between the displays
+        self.buffer_file = buffer_file
+        self.source = source
+        self.replay_file = replay_file
+        self.region = region  # (x, y, width, height) of the display to record, None - the whole display
+        self.window = window  # title of a window to follow instead of a fixed region
+        # where the frames are grabbed from
+        self.frame_source = make_source(source, display, replay_file, self.displays, region, window)
         self.with_sound = with_sound  # todo add sound recording or ditch it
         self.video_encoder = video_encoder
         self.photo_encoder = photo_encoder
@@ -350,42 +1508,88 @@ class Capture:
         # Logging
         self.verbose = verbose
 
-        # Buffer for video
-        self.manager = Manager()
-        self.buffered_frames = self.manager.list()
-
         # Multiprocessing communication
         self.is_recording = False
-        self.img_queue = Queue()
+        self.n_raw_slots = values.RAW_SLOTS + (self.encoders or values.MAX_ENCODERS)
         self.rec_conn2, self.rec_conn1 = Pipe(duplex=True)
-        self.shot_conn2, self.shot_conn1 = Pipe(duplex=True)
-        self.trim_recv, self.trim_send = Pipe(duplex=False)
         self.snap_recv, self.snap_send = Pipe(duplex=False)
-        self.mon = None  # Dimensions of monitor being captured
-
-        # Processes
+        self.mons = self.frame_source.monitors()  # Dimensions of the monitors being captured
+        self.mon = self.mons[0]
+        self.displays = self.displays[:len(self.mons)]  # A replay file has a single display
+        self.pacing_stats = PacingStats()
+        self.metrics = PipelineMetrics()
+
+        # A frame buffer (or segments) and a converter for every display, raw frames travel in shared memory
+        # unless TRANSPORT_QUEUE
+        self.streams = []
+        for i, (display, mon) in enumerate(zip(self.displays, self.mons)):
+            slot_size = mon['width'] * mon['height'] * 4 if self.transport == values.TRANSPORT_SHM else None
+            metrics = self.metrics if i == 0 else None
+            if self.buffer_mode == values.BUFFER_SEGMENTS:
+                segments = SegmentStore(os.path.splitext(self._buffer_path(i))[0] + "_segments", self.length)
+                self.streams.append(DisplayStream(display, None, self.n_raw_slots, slot_size, metrics, segments))
+                continue
+            path = self._buffer_path(i) if self.storage in (values.STORAGE_DISK, values.STORAGE_PERSISTENT) else None
+            buffer = FrameBuffer.from_config(self.length, self.fps, self.ram_usage // len(self.mons), path,
+                                             self.disk_usage // len(self.mons),
+                                             persistent=self.storage == values.STORAGE_PERSISTENT)
+            self.streams.append(DisplayStream(display, buffer, self.n_raw_slots, slot_size, metrics))
+            if buffer.recovered:
+                self._check_recovered(i)
+        # The first display is used wherever a single one is expected
+        self.buffer = self.streams[0].buffer
+        self.raw_slots = self.streams[0].raw_slots
+        self.transport_stats = self.streams[0].stats
+
+        self.export_service = ExportService([stream.buffer for stream in self.streams], export_listener, self.metrics,
+                                            verbose=self.verbose)
+        self.export_listener = export_listener
+        self.video_encoder.file_saver.prepare()
+        self.photo_encoder.file_saver.prepare()
+        if self.buffer_mode == values.BUFFER_SEGMENTS:
+            saver = self.video_encoder.file_saver
+            FileSaver(saver.directory, saver.file_prefix, values.SEGMENT_EXTENSION).prepare()
+
+        # Screenshots are encoded off the calling (hotkey/GUI) thread, one after another
+        self.shot_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="screenshot")
+        self.shot_lock = threading.Lock()  # Frame sources can't grab from several threads at once
+        self.last_shot_id = 0
+
+        # Processes are started right away and kept paused between recordings
         self.rec_process = None
-        self.conv_process = None
-        self.trim_process = None
         self._make_processes()
+        self._start_processes()
+
+        # Live metrics endpoint
+        self.metrics_server = None
+        if metrics_port:
+            self.metrics_server = MetricsServer(self.get_metrics, metrics_port)
+            self.metrics_server.start()
+            if self.verbose:
+                print(f"[Capture] Serving metrics on http://127.0.0.1:{self.metrics_server.port}/metrics")
 
         if self.verbose:
             print(f"[Capture] Initialized Capture("
-                  f"display={self.display}, "
+                  f"displays={self.displays}, "
+                  f"area={self.mon}, "
                   f"resolution={self.resolution}, "
                   f"quality={self.quality}, "
                   f"format_={self.format_}, "
                   f"fps={self.fps}, "
                   f"length={self.length}, "
+                  f"ram_usage={self.ram_usage}, "
+                  f"transport={self.transport}, "
+                  f"encoders={self.encoders}, "
+                  f"buffer_mode={self.buffer_mode}, "
+                  f"storage={self.storage}, "
+                  f"source={type(self.frame_source).__name__}, "
+                  f"disk_usage={self.disk_usage}, "
                   f"with_sound={self.with_sound})")
 
     @classmethod
-    def from_config(cls, config, video_encoder: VideoEncoder, photo_encoder: PhotoEncoder, verbose=False):
-        match = re.match(r"(?P<width>\d*)x(?P<height>\d*)", config['resolution'])
-        try:
-            resolution = (int(match['width']), int(match['height'])) if match else values.DEFAULT_RESOLUTION
-        except ValueError:
-            resolution = values.DEFAULT_RESOLUTION
+    def from_config(cls, config, video_encoder: VideoEncoder, photo_encoder: PhotoEncoder, export_listener=None,
+                    verbose=False):
+        resolution = parse_resolution(config['resolution'])
         return cls(
             video_encoder=video_encoder,
             photo_encoder=photo_encoder,
@@ -394,85 +1598,362 @@ class Capture:
             quality=config['quality'],
             fps=config['fps'],
             length=config['duration'],
+            ram_usage=config['ram_usage'],
+            transport=config['transport'],
+            encoders=config['encoders'],
+            buffer_mode=config['buffer_mode'],
+            storage=config['storage'],
+            disk_usage=config['disk_usage'],
+            buffer_file=config['buffer_file'],
+            source=config['source'],
+            replay_file=config['replay_file'],
+            metrics_port=config['metrics_port'],
+            displays=config['displays'],
+            region=parse_region(config['region']),
+            window=config['window'] or None,
             with_sound=config['save_sound'],
+            export_listener=export_listener,
             verbose=verbose
         )
 
-    def _make_processes(self):
-        self.rec_process = RecorderProcess(self.img_queue, self.rec_conn2, self.shot_conn2, self.interval,
-                                           self.display, verbose=self.verbose)
-        self.conv_process = ConvertProcess(self.img_queue, self.buffered_frames, self.trim_send, self.length,
-                                           self.fps, self.format_, self.quality, self.resolution, verbose=self.verbose)
-        self.trim_process = TrimProcess(self.buffered_frames, self.trim_recv, self.length, self.fps,
-                                        verbose=self.verbose)
+    def _buffer_path(self, stream):
+        """
+        Buffer file of a display, the first one uses `buffer_file` itself
+        """
+        if stream == 0:
+            return self.buffer_file
+        root, extension = os.path.splitext(self.buffer_file)
+        return f"{root}_{self.displays[stream]}{extension}"
+
+    def _check_recovered(self, stream):
+        """
+        Drop the frames recovered from a persistent buffer if they have another size than the frames recorded
+        now, e.g. the resolution was changed between runs
+        """
+        buffer = self.streams[stream].buffer
+        first, end = buffer.sequence_range()
+        for seq in range(end - 1, first - 1, -1):
+            frame = buffer.read(seq)
+            if frame is None or frame[0] != values.FRAME_KEY:
+                continue
+            size = Image.open(BytesIO(frame[1])).size  # Only the header is read
+            if size != self.get_frame_size(stream):
+                buffer.clear()
+                if self.verbose:
+                    print(f"[Capture] Recovered frames are {size}, not {self.get_frame_size(stream)} - dropped")
+            elif self.verbose:
+                print(f"[Capture] Recovered {end - first} frames from {buffer.path}")
+            return
+        buffer.clear()
 
-    def start_recording(self):
+    def _make_processes(self):
+        self.rec_process = RecorderProcess([stream.output() for stream in self.streams], self.rec_conn2,
+                                           self.interval, self.frame_source, self.pacing_stats, self.metrics,
+                                           verbose=self.verbose)
+        for stream in self.streams:
+            if stream.segments is not None:
+                stream.conv_process = SegmentProcess(stream.img_queue, stream.segments, self.fps, self.quality,
+                                                     stream.stats, stream.raw_slots, self.resolution, stream.metrics,
+                                                     stream.conv_send, verbose=self.verbose)
+                continue
+            stream.conv_process = ConvertProcess(stream.img_queue, stream.buffer, self.length, self.fps, self.format_,
+                                                 self.quality, stream.stats, stream.raw_slots, self.resolution,
+                                                 self.encoders, self.buffer_mode, stream.metrics, stream.conv_send,
+                                                 verbose=self.verbose)
+
+    def _start_processes(self):
         if self.verbose:
-            self.rec_process.verbose = True
-            self.conv_process.verbose = True
-            self.trim_process.verbose = True
-
-        self.is_recording = True
-
-        # Run all the processes
+            print("[Capture] Starting processes...")
         self.rec_process.start()
-        self.conv_process.start()
-        self.trim_process.start()
-        return True
-
-    def stop_recording(self):
-        if not self.rec_process.is_alive():
-            if self.verbose:
-                print("[Capture] Processes haven't started")
-            return False
+        for stream in self.streams:
+            stream.conv_process.start()
 
+    def _stop_processes(self):
         if self.verbose:
             print("[Capture] Killing processes...")
-        self.rec_conn1.send(values.TASK_KILL)
-
-        self.rec_process.join()
-        self.conv_process.join()
-        self.trim_process.join()
-
+        if self.rec_process.is_alive():
+            self.rec_conn1.send(values.TASK_KILL)
+        else:
+            for stream in self.streams:  # The recorder can't pass the kill on
+                try:
+                    stream.img_queue.put_nowait(None)
+                except queue.Full:
+                    pass  # Terminated below
+        self._join(self.rec_process)
+        for stream in self.streams:
+            self._join(stream.conv_process)
         if self.verbose:
             print("[Capture] Processes joined")
 
-        self.is_recording = False
-
-        # Set-up for next recording
-        self.img_queue = Queue()
-
-        self.buffered_frames = self.manager.list()
+    def _join(self, process):
+        """
+        Wait for a process to finish, terminate it if it's stuck
+        """
+        process.join(values.TASK_TIMEOUT + values.TASK_POLL)
+        if process.is_alive():
+            if self.verbose:
+                print(f"[Capture] {process.name} not finishing, terminating it")
+            process.terminate()
+            process.join()
+
+    def _wait_for_converters(self):
+        """
+        Wait for every converter to acknowledge the last task. A converter that died is given up on, it would
+        never answer. So is one whose task was lost with the recorder.
+        """
+        for stream in self.streams:
+            while not stream.conv_recv.poll(values.TASK_POLL):
+                if not stream.conv_process.is_alive():
+                    if self.verbose:
+                        print(f"[Capture] Converter of display {stream.display} died "
+                              f"(exitcode={stream.conv_process.exitcode})")
+                    break
+                if not self.rec_process.is_alive():
+                    if self.verbose:
+                        print(f"[Capture] Recorder died (exitcode={self.rec_process.exitcode})")
+                    return
+            else:
+                stream.conv_recv.recv()
 
-        self._make_processes()
+    def _poll_monitors(self):
+        """
+        Take the monitors the recorder reported since the last call
+        """
+        while self.rec_conn1.poll():
+            self.mons = self.rec_conn1.recv()
+            self.mon = self.mons[0]
 
+    def start_recording(self):
+        if self.is_recording or not self.rec_process.is_alive():
+            return False
+        self.rec_conn1.send(values.TASK_RESUME)
+        self.is_recording = True
         return True
 
-    def export_recording(self):
+    def stop_recording(self):
+        """
+        Pause the processes, they are kept for the next recording. The buffered frames are dropped, unless the
+        buffer is persistent.
+        """
         if not self.is_recording:
+            if self.verbose:
+                print("[Capture] Not recording")
             return False
-        if self.rec_conn1.poll():
-            self.mon = self.rec_conn1.recv()
-
-        screen_size = (self.mon['width'], self.mon['height']) if self.mon is not None else values.DEFAULT_SCREEN_SIZE
-
-        frames = list(self.buffered_frames[-self.length * self.fps:])
-        del self.buffered_frames[:]  # Clear the buffer
 
+        if self.rec_process.is_alive():  # A dead recorder has stopped grabbing already
+            self.rec_conn1.send(values.TASK_PAUSE)
+            self._wait_for_converters()  # They have stored the frames in flight and cleared the buffers
+        self.is_recording = False
+        for stream in self.streams:
+            stream.metrics.reset()
         if self.verbose:
-            print(f"[Capture] Exporting {len(frames)} frames")
+            print("[Capture] Recording paused")
+        return True
 
-        self.video_encoder.encode(frames, screen_size)
+    def reconfigure(self, fps=None, quality=None, resolution=None, display=None, region=None, window=None):
+        """
+        Apply new settings to the running processes, the recording isn't interrupted. Changing the frame size
+        (resolution, display or the captured area) drops the buffered frames.
+        :param resolution: (width, height) or None to keep the monitor resolution - always applied
+        :param display: only when recording a single display
+        :param region: (x, y, width, height) or None for the whole display - always applied
+        :param window: title of the window to follow or None - always applied
+        :return: False if the settings can't be applied live and a new Capture is needed
+        """
+        changes = {}
+        if fps is not None and fps != self.fps:
+            if self.buffer is not None and self.length * fps > self.buffer.capacity:
+                return False  # The index was sized for the old frame rate
+            changes['fps'] = fps
+        if quality is not None and quality != self.quality:
+            changes['quality'] = quality
+        if resolution != self.resolution:
+            changes['resolution'] = resolution
+            changes['clear'] = True
+        display = self.display if display is None else display
+        if (display, region, window) != (self.display, self.region, self.window):
+            if len(self.streams) > 1:
+                return False
+            frame_source = make_source(self.source, display, self.replay_file, region=region, window=window)
+            mon = frame_source.monitor()
+            if self.raw_slots is not None and mon['width'] * mon['height'] * 4 > self.raw_slots.slot_size:
+                return False  # Raw frames of the new area don't fit the shared memory slots
+            changes['source'] = frame_source
+            changes['clear'] = True
+        if not changes:
+            return True
+        if not self.rec_process.is_alive():
+            return False  # Nothing to apply the settings to
+
+        self.rec_conn1.send((values.TASK_CONFIG, changes))
+        self._wait_for_converters()  # Applied by the converters, the recorder goes first
+        if 'source' in changes:
+            self.frame_source, self.display = changes['source'], display
+            self.region, self.window = region, window
+            self.displays = [display]
+            self.streams[0].display = display
+            self._poll_monitors()
+        if 'fps' in changes:
+            self.fps = fps
+            self.interval = (1 / self.fps) * pow(10, 9)
+            self.video_encoder.fps = fps
+        self.quality = quality if quality is not None else self.quality
+        self.resolution = resolution
+        if self.verbose:
+            print(f"[Capture] Reconfigured {changes}")
         return True
 
+    def export_recording(self, display=None, composite=False):
+        """
+        Queue an export of the buffered replay. The file is written in the background; progress and the result
+        are passed to the export listener. Frames recovered from a persistent buffer can be exported before
+        the recording is started.
+        :param display: display to export, None - the first one
+        :param composite: put all recorded displays into one video, arranged like on the desktop. Not with
+                          BUFFER_SEGMENTS, the display is exported on its own.
+        :return: job id, None if too many exports are queued, False if there is nothing to export
+        """
+        stream = self.displays.index(display) if display is not None else 0
+        if self.streams[stream].segments is not None:
+            return self.export_service.submit_segments(self.video_encoder, self.length, self.streams[stream].segments)
+        if not self.is_recording and len(self.streams[stream].buffer) == 0:
+            return False
+        self._poll_monitors()
+
+        if composite and len(self.streams) > 1:
+            size, placements = composite_layout(self.mons, self.resolution)
+            parts = [(i, self.get_frame_size(i), placement) for i, placement in enumerate(placements)]
+        else:
+            size = self.get_frame_size(stream)
+            parts = [(stream, size, None)]
+        return self.export_service.submit(self.video_encoder, self.length, self.format_, parts, size)
+
+    def cancel_export(self, job_id):
+        self.export_service.cancel(job_id)
+
+    def _grab_screenshot(self):
+        """
+        :return: RawFrame with the newest recorded frame of the first display if it's fresh, otherwise a new
+                 grab from the screen
+        """
+        if self.is_recording and self.raw_slots is not None:
+            latest = self.raw_slots.latest(max_age=values.SHOT_MAX_AGE * self.interval)
+            if latest is not None:
+                raw, size, _ = latest
+                return RawFrame(raw, size)
+        with self.shot_lock, self.frame_source as source:
+            return source.grab().detached()
+
+    def _save_screenshot(self, shot_id, frame, start):
+        try:
+            path = self.photo_encoder.encode(frame, frame.size, self.resolution)
+        except Exception as e:
+            event = (values.SHOT_FAILED, shot_id, repr(e))
+        else:
+            latency = (time.perf_counter_ns() - start) / pow(10, 9)
+            self.metrics.screenshot_seconds.observe(latency)
+            event = (values.SHOT_DONE, shot_id, path, latency)
+        if self.verbose:
+            print(f"[Capture] {event}")
+        if self.export_listener is not None:
+            self.export_listener(*event)
+
     def export_screenshot(self):
-        self.rec_conn1.send(values.TASK_SHOT)
-        while not self.shot_conn1.poll():
-            pass
-        if self.rec_conn1.poll():
-            self.mon = self.rec_conn1.recv()
-        screen_size = (self.mon['width'], self.mon['height']) if self.mon is not None else values.DEFAULT_SCREEN_SIZE
-        self.photo_encoder.encode(self.shot_conn1.recv(), screen_size, self.resolution)
+        """
+        Take a screenshot and save it in the background. SHOT_DONE (path, seconds from the request until the
+        file was written) or SHOT_FAILED (error) is passed to the export listener.
+        :return: screenshot id
+        """
+        start = time.perf_counter_ns()
+        frame = self._grab_screenshot()
+        self.last_shot_id += 1
+        self.shot_executor.submit(self._save_screenshot, self.last_shot_id, frame, start)
+        return self.last_shot_id
+
+    def get_frame_size(self, stream=0):
+        """
+        :param stream: index of the display in `displays`
+        :return: (width, height) of the buffered frames
+        """
+        mon = self.mons[stream]
+        return scaled_size((mon['width'], mon['height']), self.resolution)
 
     def get_video_encoder(self):
         return self.video_encoder
+
+    def get_transport_stats(self):
+        """
+        :return: dict with the number of grabbed, dropped and converted frames and the current queue depth
+        """
+        return self.transport_stats.get()
+
+    def get_pacing_stats(self):
+        """
+        :return: dict with target and measured fps, skipped frames and frame timing jitter percentiles (us)
+        """
+        return self.pacing_stats.get()
+
+    def get_buffer_usage(self):
+        """
+        :return: dict with the measured size of the buffered frames (or segments) and the size of the buffers
+                 (bytes) of all displays, the buffered duration (seconds) and the quality and frame step currently
+                 used to stay within the budget, of the first display
+        """
+        usage = [stream.usage(self.fps) for stream in self.streams]
+        stats = self.transport_stats.get()
+        return {
+            'used': sum(used for used, _, _ in usage),
+            'budget': sum(size for _, _, size in usage),
+            'seconds': usage[0][1],
+            'quality': stats['quality'],
+            'frame_step': stats['frame_step'],
+        }
+
+    def get_metrics(self):
+        """
+        :return: dict with 'counters', 'gauges' and 'histograms' of the whole pipeline, see render_prometheus.
+                 Counters and buffer sizes cover all displays, the rest is measured on the first one.
+        """
+        stats = [stream.stats.get() for stream in self.streams]
+        pacing = self.pacing_stats.get()
+        usage = [stream.usage(self.fps) for stream in self.streams]
+        counters = {
+            'grabbed_frames_total': sum(s['grabbed'] for s in stats),
+            'dropped_frames_total': sum(s['dropped'] for s in stats),
+            'converted_frames_total': sum(s['converted'] for s in stats),
+            'pacing_missed_frames_total': pacing['missed'],
+        }
+        for i, counter in enumerate(self.metrics.counters()):
+            counters[counter.name] = sum(stream.metrics.counters()[i].get() for stream in self.streams)
+        return {
+            'counters': counters,
+            'gauges': {
+                'recording': int(self.is_recording),
+                'displays': len(self.streams),
+                'queue_depth': sum(s['queue_depth'] for s in stats),
+                'quality': stats[0]['quality'] or None,
+                'frame_step': stats[0]['frame_step'] or None,
+                'buffer_used_bytes': sum(used for used, _, _ in usage),
+                'buffer_size_bytes': sum(size for _, _, size in usage),
+                'buffer_frames': round(sum(seconds for _, seconds, _ in usage) * self.fps),
+                'buffer_seconds': usage[0][1],
+                'target_fps': pacing['target_fps'],
+                'actual_fps': pacing['actual_fps'],
+                'pacing_jitter_p95_us': pacing['jitter_p95_us'],
+            },
+            'histograms': {histogram.name: histogram.get() for histogram in self.metrics.histograms()},
+        }
+
+    def close(self):
+        """
+        Stop the recording and free the shared frame buffers. The object can't be used afterwards.
+        """
+        if self.is_recording:
+            self.stop_recording()
+        self._stop_processes()
+        self.shot_executor.shutdown()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.export_service.stop()
+        for stream in self.streams:
+            stream.close()
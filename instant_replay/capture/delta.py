@@ -0,0 +1,91 @@
+import math
+import struct
+
+import numpy as np
+
+import instant_replay.values as values
+from instant_replay.lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+
+# tile size, grid width, grid height, atlas columns, number of changed tiles
+_HEADER = struct.Struct("<HHHHI")
+
+
+def _grid(shape, tile):
+    return math.ceil(shape[1] / tile), math.ceil(shape[0] / tile)
+
+
+def changed_tiles(current, previous, tile=values.DELTA_TILE):
+    """
+    Compare two raw frames tile by tile
+    :param current: numpy array of shape (height, width, 4)
+    :param previous: numpy array of the same shape
+    :return: boolean array of shape (tiles down, tiles across), True where any pixel differs
+    """
+    # Compare whole BGRA pixels at once
+    diff = current.view(np.uint32)[..., 0] != previous.view(np.uint32)[..., 0]
+    rows = np.logical_or.reduceat(diff, np.arange(0, diff.shape[0], tile), axis=0)
+    return np.logical_or.reduceat(rows, np.arange(0, diff.shape[1], tile), axis=1)
+
+
+def encode_delta(current, previous, quality, tile=values.DELTA_TILE):
+    """
+    Encode only the tiles of `current` that differ from `previous`. The changed tiles are packed into an atlas
+    compressed as a single JPEG. Tiles are multiples of 16 pixels, so JPEG blocks never cross tile borders.
+    :return: b"" if nothing changed, None if too much changed for a delta to pay off, else the encoded delta
+    """
+    changed = changed_tiles(current, previous, tile)
+    n = int(np.count_nonzero(changed))
+    if n == 0:
+        return b""
+    if n > changed.size * values.DELTA_MAX_CHANGED:
+        return None
+
+    grid_w, grid_h = _grid(current.shape, tile)
+    tiles = np.flatnonzero(changed).astype(np.uint16)
+    cols = math.ceil(math.sqrt(n))
+    atlas = np.zeros((math.ceil(n / cols) * tile, cols * tile, 3), dtype=np.uint8)
+    for i, index in enumerate(tiles):
+        y, x = divmod(int(index), grid_w)
+        src = current[y * tile:(y + 1) * tile, x * tile:(x + 1) * tile, :3]
+        ay, ax = divmod(i, cols)
+        atlas[ay * tile:ay * tile + src.shape[0], ax * tile:ax * tile + src.shape[1]] = src
+
+    _, jpeg = cv2.imencode(".jpg", atlas, (cv2.IMWRITE_JPEG_QUALITY, quality))
+    return _HEADER.pack(tile, grid_w, grid_h, cols, n) + tiles.tobytes() + jpeg.tobytes()
+
+
+class DeltaDecoder:
+    """
+    Rebuilds full BGR frames from a sequence of key, delta and repeated frames. Returned arrays are never
+    modified afterwards, so they can be queued.
+    """
+
+    def __init__(self):
+        self.canvas = None
+
+    def decode(self, kind, data):
+        """
+        :param kind: values.FRAME_KEY, FRAME_DELTA or FRAME_REPEAT
+        :param data: encoded frame as stored in the buffer
+        :return: BGR numpy array or None if there is no keyframe to apply the delta to yet
+        """
+        if kind == values.FRAME_KEY:
+            self.canvas = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            return self.canvas
+        if self.canvas is None or kind == values.FRAME_REPEAT:
+            return self.canvas
+
+        tile, grid_w, grid_h, cols, n = _HEADER.unpack_from(data)
+        tiles = np.frombuffer(data, dtype=np.uint16, count=n, offset=_HEADER.size)
+        atlas = cv2.imdecode(np.frombuffer(data, dtype=np.uint8, offset=_HEADER.size + 2 * n), cv2.IMREAD_COLOR)
+
+        canvas = self.canvas.copy()
+        for i, index in enumerate(tiles):
+            y, x = divmod(int(index), grid_w)
+            dst = canvas[y * tile:(y + 1) * tile, x * tile:(x + 1) * tile]
+            ay, ax = divmod(i, cols)
+            dst[...] = atlas[ay * tile:ay * tile + dst.shape[0], ax * tile:ax * tile + dst.shape[1]]
+        self.canvas = canvas
+        return canvas
@@ -0,0 +1,200 @@
+import bisect
+import multiprocessing
+import threading
+
+# Histogram bucket upper bounds
+_SECONDS_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+_EXPORT_BOUNDS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)
+_BYTES_BOUNDS = (1024, 4096, 16384, 65536, 131072, 262144, 524288, 1048576, 2097152, 4194304)
+
+_PREFIX = "instant_replay_"
+
+
+class Counter:
+    """
+    Monotonic counter in shared memory. Like TransportStats, every counter must have a single writing process.
+    """
+
+    def __init__(self,
+                 name,
+                 help_):
+        self.name = name
+        self.help = help_
+        self._value = multiprocessing.RawValue('d', 0)
+
+    def increment(self, amount=1):
+        self._value.value += amount
+
+    def reset(self):
+        self._value.value = 0
+
+    def get(self):
+        return self._value.value
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram in shared memory, with a single writing process
+    """
+
+    def __init__(self,
+                 name,
+                 help_,
+                 bounds):
+        self.name = name
+        self.help = help_
+        self.bounds = bounds
+        # Count per bucket (the last one is +Inf), then the sum and the count of all observations
+        self._values = multiprocessing.RawArray('d', len(bounds) + 3)
+
+    def observe(self, value):
+        self._values[bisect.bisect_left(self.bounds, value)] += 1
+        self._values[-2] += value
+        self._values[-1] += 1
+
+    def reset(self):
+        for i in range(len(self._values)):
+            self._values[i] = 0
+
+    def get(self):
+        """
+        :return: dict with cumulative bucket counts as (upper bound, count) pairs, the sum, the count and
+                 the median and 95th percentile estimated from the buckets
+        """
+        values = self._values[:]
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), values[:-2]):
+            total += count
+            buckets.append((bound, total))
+        return {
+            'help': self.help,
+            'buckets': buckets,
+            'sum': values[-2],
+            'count': values[-1],
+            'p50': self._quantile(buckets, values[-1], 0.5),
+            'p95': self._quantile(buckets, values[-1], 0.95),
+        }
+
+    @staticmethod
+    def _quantile(buckets, count, q):
+        """
+        Upper bound of the bucket the quantile falls into, None without observations
+        """
+        if not count:
+            return None
+        for bound, cumulative in buckets:
+            if cumulative >= q * count:
+                return bound
+        return None
+
+
+class PipelineMetrics:
+    """
+    Per-stage measurements written by the capture processes. Counters of grabbed, dropped and converted
+    frames are in TransportStats, frame pacing in PacingStats - Capture.get_metrics puts them all together.
+    """
+
+    def __init__(self):
+        # Written by the recorder
+        self.grab_seconds = Histogram("grab_seconds", "Time to grab a frame of every recorded display and "
+                                                      "hand them to the converters",
+                                      _SECONDS_BOUNDS)
+        # Written by the converter
+        self.queue_wait_seconds = Histogram("queue_wait_seconds", "Time from capture until the converter takes "
+                                                                  "the frame", _SECONDS_BOUNDS)
+        self.encode_seconds = Histogram("encode_seconds", "Time to encode a frame", _SECONDS_BOUNDS)
+        self.frame_bytes = Histogram("frame_bytes", "Size of an encoded frame", _BYTES_BOUNDS)
+        self.buffer_dropped = Counter("buffer_dropped_frames_total", "Encoded frames that didn't fit in the buffer")
+        # Written by the exporter
+        self.export_seconds = Histogram("export_seconds", "Time to write a replay file", _EXPORT_BOUNDS)
+        self.export_frames = Counter("export_frames_total", "Frames written to replay files")
+        self.exports_failed = Counter("exports_failed_total", "Exports that failed")
+        # Written by the screenshot thread of the main process
+        self.screenshot_seconds = Histogram("screenshot_seconds", "Time from a screenshot request until the file "
+                                                                  "is written", _SECONDS_BOUNDS)
+
+    def histograms(self):
+        return [self.grab_seconds, self.queue_wait_seconds, self.encode_seconds, self.frame_bytes,
+                self.export_seconds, self.screenshot_seconds]
+
+    def counters(self):
+        return [self.buffer_dropped, self.export_frames, self.exports_failed]
+
+    def reset(self):
+        """
+        Reset the recording metrics, export metrics are kept
+        """
+        for metric in (self.grab_seconds, self.queue_wait_seconds, self.encode_seconds, self.frame_bytes,
+                       self.buffer_dropped):
+            metric.reset()
+
+
+def render_prometheus(metrics):
+    """
+    :param metrics: dict from Capture.get_metrics
+    :return: metrics in the Prometheus text exposition format
+    """
+    lines = []
+    for kind in ('counters', 'gauges'):
+        for name, value in metrics[kind].items():
+            if value is None:
+                continue
+            name = _PREFIX + name
+            lines.append(f"# TYPE {name} {'counter' if kind == 'counters' else 'gauge'}")
+            lines.append(f"{name} {value}")
+    for name, histogram in metrics['histograms'].items():
+        name = _PREFIX + name
+        lines.append(f"# HELP {name} {histogram['help']}")
+        lines.append(f"# TYPE {name} histogram")
+        for bound, count in histogram['buckets']:
+            le = "+Inf" if bound == float("inf") else bound
+            lines.append(f'{name}_bucket{{le="{le}"}} {count}')
+        lines.append(f"{name}_sum {histogram['sum']}")
+        lines.append(f"{name}_count {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves `get_metrics()` on http://host:port/metrics in the Prometheus text format, from a daemon thread
+    """
+
+    def __init__(self,
+                 get_metrics,
+                 port,
+                 host="127.0.0.1"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # Only when metrics are served
+
+        get = get_metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render_prometheus(get()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format_, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
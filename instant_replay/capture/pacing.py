@@ -0,0 +1,97 @@
+import multiprocessing
+import time
+from collections import deque
+
+import instant_replay.values as values
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+class FramePacer:
+    """
+    Schedules frames against absolute deadlines (start + n * interval), so the time spent grabbing a frame
+    doesn't add up to drift. Most of the wait is spent sleeping, only the last `spin` nanoseconds are
+    busy-waited to hit the deadline precisely. Deadlines that were missed completely are skipped, not caught up.
+    """
+
+    def __init__(self,
+                 interval,
+                 spin=values.PACER_SPIN_NS,
+                 history=values.PACER_HISTORY):
+        self.interval = int(interval)
+        self.spin = spin
+        self.deadline = None
+        self.missed = 0
+
+        self._ticks = deque(maxlen=history)  # Wake-up timestamps
+        self._jitter = deque(maxlen=history)  # Wake-up delay after the deadline
+
+    def start(self):
+        self.deadline = time.perf_counter_ns()
+        self.missed = 0
+        self._ticks.clear()
+        self._jitter.clear()
+        return self.deadline
+
+    def wait(self):
+        """
+        Block until the next frame is due.
+        :return: perf_counter_ns timestamp of the wake-up
+        """
+        if self.deadline is None:
+            return self.start()
+
+        self.deadline += self.interval
+        now = time.perf_counter_ns()
+        if now >= self.deadline + self.interval:
+            skipped = (now - self.deadline) // self.interval
+            self.deadline += skipped * self.interval
+            self.missed += skipped
+
+        sleep_for = self.deadline - now - self.spin
+        if sleep_for > 0:
+            time.sleep(sleep_for / 1e9)
+        while (now := time.perf_counter_ns()) < self.deadline:
+            pass
+
+        self._ticks.append(now)
+        self._jitter.append(now - self.deadline)
+        return now
+
+    def stats(self):
+        """
+        :return: dict with target and measured fps, frames skipped and wake-up jitter percentiles in microseconds
+        """
+        actual_fps = 0.0
+        if len(self._ticks) > 1:
+            actual_fps = (len(self._ticks) - 1) * 1e9 / (self._ticks[-1] - self._ticks[0])
+        jitter = sorted(self._jitter)
+        return {
+            'target_fps': 1e9 / self.interval,
+            'actual_fps': actual_fps,
+            'missed': self.missed,
+            'jitter_p50_us': _percentile(jitter, 50) / 1000,
+            'jitter_p95_us': _percentile(jitter, 95) / 1000,
+            'jitter_p99_us': _percentile(jitter, 99) / 1000,
+        }
+
+
+class PacingStats:
+    """
+    Latest FramePacer.stats() published by the recording process for the parent process to read.
+    """
+    KEYS = ('target_fps', 'actual_fps', 'missed', 'jitter_p50_us', 'jitter_p95_us', 'jitter_p99_us')
+
+    def __init__(self):
+        self._values = multiprocessing.RawArray('d', len(self.KEYS))
+
+    def publish(self, stats):
+        for i, key in enumerate(self.KEYS):
+            self._values[i] = stats[key]
+
+    def get(self):
+        return dict(zip(self.KEYS, self._values[:]))
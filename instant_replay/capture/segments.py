@@ -0,0 +1,241 @@
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+
+import instant_replay.values as values
+
+_LIST_FILE = "segments.csv"
+_TS_PACKET = 188  # Bytes, an MPEG-TS file can be cut after any whole packet
+
+
+def segments_available():
+    return shutil.which(values.FFMPEG_BINARY) is not None
+
+
+class SegmentStore:
+    """
+    Directory with the rolling set of MPEG-TS segments of one display. ffmpeg's segment muxer writes them with
+    continuous timestamps, so any run of consecutive segments is a valid stream as the bytes are. The oldest
+    segment is overwritten once `count` of them exist.
+    """
+
+    def __init__(self,
+                 directory,
+                 length):
+        """
+        :param length: seconds of video to keep
+        """
+        self.directory = directory
+        self.count = math.ceil(length / values.SEGMENT_SECONDS) + values.SEGMENT_SPARE
+
+    @property
+    def list_path(self):
+        return os.path.join(self.directory, _LIST_FILE)
+
+    @property
+    def pattern(self):
+        return os.path.join(self.directory, "segment_%03d.ts")
+
+    def _path(self, index):
+        return self.pattern % index
+
+    def clear(self):
+        """
+        Remove all segments, e.g. after the recording was paused
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for file in os.listdir(self.directory):
+            if file.endswith(".ts") or file == _LIST_FILE:
+                try:
+                    os.remove(os.path.join(self.directory, file))
+                except OSError:
+                    pass
+
+    def segments(self):
+        """
+        :return: [(path, start, end)] of the finished segments, oldest first. Start and end are in seconds.
+        """
+        try:
+            with open(self.list_path) as file:
+                lines = file.read().splitlines()
+        except OSError:
+            return []
+        segments = []
+        for line in lines:
+            try:
+                name, start, end = line.rsplit(",", 2)
+                segments.append((os.path.join(self.directory, name), float(start), float(end)))
+            except ValueError:
+                continue  # Being rewritten by ffmpeg
+        return segments
+
+    def _current(self, segments):
+        """
+        :return: path of the segment being written after the finished `segments`, None if there is none yet
+        """
+        if not segments:
+            path = self._path(0)
+        else:
+            name = os.path.basename(segments[-1][0])
+            index = int(name[len("segment_"):-len(".ts")])
+            path = self._path((index + 1) % self.count)
+        try:
+            modified = os.path.getmtime(path)
+            # Not reopened by ffmpeg yet after wrapping, the file still holds an old segment
+            if segments and modified < os.path.getmtime(segments[-1][0]):
+                return None
+        except OSError:
+            return None
+        return path
+
+    def recorded(self):
+        """
+        :return: True if there is anything to export, only the segment list is read
+        """
+        segments = self.segments()
+        if segments:
+            return True
+        current = self._current(segments)
+        try:
+            return current is not None and os.path.getsize(current) > 0
+        except OSError:
+            return False
+
+    def used_bytes(self):
+        """
+        :return: (size of the segments in bytes, seconds in the finished segments)
+        """
+        segments = self.segments()
+        used = 0
+        for path in [path for path, _, _ in segments] + [self._current(segments)]:
+            try:
+                used += os.path.getsize(path) if path is not None else 0
+            except OSError:
+                pass
+        return used, sum(end - start for _, start, end in segments)
+
+    def snapshot(self, duration):
+        """
+        Copy the newest segments covering `duration`, including the one being written, so that ffmpeg can keep
+        overwriting them while the copies are exported
+        :param duration: seconds, rounded up to whole segments
+        :return: SegmentSnapshot or None if nothing was recorded yet
+        """
+        segments = self.segments()
+        current = self._current(segments)
+        paths = [current] if current is not None else []
+        covered = 0
+        for path, start, end in reversed(segments):
+            if covered >= duration:
+                break
+            paths.insert(0, path)
+            covered += end - start
+
+        copies = []
+        directory = tempfile.mkdtemp(prefix="export_", dir=self.directory)
+        for i, path in enumerate(paths):
+            copy = os.path.join(directory, f"{i}.ts")
+            try:
+                with open(path, "rb") as source, open(copy, "wb") as target:
+                    shutil.copyfileobj(source, target)
+                    size = target.tell()
+                    target.truncate(size - size % _TS_PACKET)  # The current segment may end mid-packet
+            except OSError:
+                continue
+            if os.path.getsize(copy):
+                copies.append(copy)
+        if not copies:
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+        return SegmentSnapshot(directory, copies)
+
+
+class SegmentSnapshot:
+    """
+    Copies of the segments of one export, owned by the export until it's released
+    """
+
+    def __init__(self,
+                 directory,
+                 paths):
+        self.directory = directory
+        self.paths = paths
+
+    def join(self, output_path):
+        """
+        Put the segments into one MP4 file without re-encoding them
+        """
+        process = subprocess.run([values.FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+                                  "-i", "concat:" + "|".join(self.paths), "-c", "copy", "-movflags", "+faststart",
+                                  output_path], stdin=subprocess.DEVNULL, capture_output=True)
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {process.stderr.decode(errors='replace').strip()}")
+        return output_path
+
+    def release(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class SegmentEncoder:
+    """
+    ffmpeg process encoding the raw BGRA frames piped to it into the segments of a SegmentStore, keyframes are
+    forced at the segment boundaries
+    """
+
+    def __init__(self,
+                 store: SegmentStore,
+                 size,
+                 frame_size,
+                 fps,
+                 quality):
+        """
+        :param size: (width, height) of the raw frames
+        :param frame_size: (width, height) of the video
+        :param quality: 1-95 like the JPEG quality, mapped to the x264 constant rate factor
+        """
+        self.size = size
+        self.fps = fps
+        crf = round(values.SEGMENT_CRF_WORST - quality * (values.SEGMENT_CRF_WORST - values.SEGMENT_CRF_BEST) / 95)
+        filters = "pad=ceil(iw/2)*2:ceil(ih/2)*2"  # yuv420p needs even dimensions
+        if frame_size != size:
+            filters = f"scale={frame_size[0]}:{frame_size[1]}:flags=area," + filters
+        command = [values.FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+                   "-f", "rawvideo", "-pix_fmt", "bgra", "-s", f"{size[0]}x{size[1]}", "-framerate", str(fps),
+                   "-i", "-", "-vf", filters,
+                   "-c:v", "libx264", *values.SEGMENT_PRESET, "-crf", str(crf), "-pix_fmt", "yuv420p",
+                   "-threads", str(values.FFMPEG_THREADS),
+                   "-force_key_frames", f"expr:gte(t,n_forced*{values.SEGMENT_SECONDS})",
+                   "-f", "segment", "-segment_time", str(values.SEGMENT_SECONDS), "-segment_format", "mpegts",
+                   "-segment_wrap", str(store.count), "-segment_list", store.list_path,
+                   "-segment_list_type", "csv", "-segment_list_size", str(store.count), store.pattern]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        self._tick = None
+        self._interval = pow(10, 9) / fps
+
+    def ticks(self, timestamp):
+        """
+        Frames of the constant rate video due up to the frame captured at `timestamp`. Late frames are
+        written several times, frames coming too fast not at all. Longer gaps (EXPORT_MAX_GAP) are cut short.
+        """
+        if self._tick is None or timestamp - self._tick > values.EXPORT_MAX_GAP * pow(10, 9):
+            self._tick = timestamp
+        n = 0
+        while self._tick <= timestamp + self._interval / 2:
+            self._tick += self._interval
+            n += 1
+        return n
+
+    def write(self, raw):
+        self.process.stdin.write(raw)
+
+    def close(self):
+        """
+        Finish the segment being written and wait for ffmpeg
+        """
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
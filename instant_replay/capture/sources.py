@@ -0,0 +1,682 @@
+import bisect
+import ctypes
+import ctypes.util
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from abc import abstractmethod
+
+import mss
+
+import instant_replay.values as values
+
+
+def _pick_monitor(monitors, display):
+    """
+    Displays can be unplugged after they were saved in the config - fall back to the first one
+    """
+    return monitors[display if 0 < display < len(monitors) else 1]
+
+
+def get_monitor(display):
+    """
+    :return: mss monitor dict (left, top, width, height) of the given display
+    """
+    with mss.mss() as sct:
+        return _pick_monitor(sct.monitors, display)
+
+
+def n_of_displays():
+    with mss.mss() as sct:
+        return len(sct.monitors) - 1
+
+
+def parse_region(text):
+    """
+    :param text: "WIDTHxHEIGHT+X+Y" (X11 geometry) with the offset from the top left corner of the display
+    :return: (x, y, width, height) or None for the whole display
+    """
+    match = re.fullmatch(r"\s*(?P<width>\d+)x(?P<height>\d+)\+(?P<x>\d+)\+(?P<y>\d+)\s*", text or "")
+    if not match or not int(match['width']) or not int(match['height']):
+        return None
+    return int(match['x']), int(match['y']), int(match['width']), int(match['height'])
+
+
+def _bounded(mon, left, top, width, height):
+    """
+    Rectangle moved and cut to lie within the display, with even dimensions for the video codecs
+    :return: monitor dict
+    """
+    width = max(2, min(width, mon['width']) // 2 * 2)
+    height = max(2, min(height, mon['height']) // 2 * 2)
+    return {'left': min(max(left, mon['left']), mon['left'] + mon['width'] - width),
+            'top': min(max(top, mon['top']), mon['top'] + mon['height'] - height),
+            'width': width,
+            'height': height}
+
+
+class CaptureArea:
+    """
+    Part of a display that is grabbed: the whole display, a fixed region of it, or the inside of a window that
+    is followed when it moves. The size is settled on the first `monitor()` call, so that all frames (and the
+    shared memory sized for them) stay the same - a resized window keeps being grabbed at its first size.
+    """
+
+    def __init__(self,
+                 display=values.DEFAULT_DISPLAY,
+                 region=None,
+                 window=None):
+        """
+        :param region: (x, y, width, height) relative to the display, None - the whole display
+        :param window: part of the title of an X11 window to follow, used instead of `region` while it's open
+        """
+        self.display = display
+        self.region = region
+        self.window = window
+        self._display_mon = None
+        self._mon = None
+        self._tracker = None
+        self._polled = 0
+
+    def monitor(self):
+        """
+        :return: monitor dict (left, top, width, height) of the grabbed area
+        """
+        if self._mon is None:
+            self._display_mon = get_monitor(self.display)
+            self._mon = self._display_mon
+            if self.region is not None:
+                x, y, width, height = self.region
+                self._mon = _bounded(self._display_mon, self._display_mon['left'] + x, self._display_mon['top'] + y,
+                                     width, height)
+            if self.window and x11_available():
+                with WindowTracker(self.window) as tracker:
+                    geometry = tracker.geometry()
+                if geometry is not None:
+                    self._mon = _bounded(self._display_mon, *geometry)
+        return self._mon
+
+    def open(self):
+        self.monitor()
+        if self.window and x11_available():
+            self._tracker = WindowTracker(self.window)
+            self._tracker.open()
+        return self._mon
+
+    def follow(self):
+        """
+        Move the area after the window, the window is looked up at most every WINDOW_POLL seconds
+        :return: monitor dict of the area to grab now
+        """
+        if self._tracker is None:
+            return self._mon
+        now = time.perf_counter()
+        if now - self._polled >= values.WINDOW_POLL:
+            self._polled = now
+            geometry = self._tracker.geometry()
+            if geometry is not None:
+                self._mon = _bounded(self._display_mon, geometry[0], geometry[1], self._mon['width'],
+                                     self._mon['height'])
+        return self._mon
+
+    def close(self):
+        if self._tracker is not None:
+            self._tracker.close()
+            self._tracker = None
+
+
+class RawFrame:
+    """
+    Raw BGRA screenshot as returned by the frame sources - same attributes as an mss screenshot
+    """
+
+    def __init__(self,
+                 raw,
+                 size,
+                 owned=True):
+        self.raw = raw  # bytes-like
+        self.size = size  # (width, height)
+        self.owned = owned  # False - `raw` is memory the source reuses for the next frame
+
+    @property
+    def bgra(self):
+        return bytes(self.raw)
+
+    def detached(self):
+        """
+        :return: frame that owns its pixels, so it can be kept or pickled after the next grab
+        """
+        if self.owned:
+            return self
+        return RawFrame(bytes(self.raw), self.size)
+
+    def __getstate__(self):
+        return bytes(self.raw), self.size
+
+    def __setstate__(self, state):
+        self.raw, self.size = state
+        self.owned = True
+
+
+class FrameSource:
+    """
+    Where the recorder takes its frames from. Sources are created in the parent process and passed to the
+    recording process, so all handles must be opened in `open`, not in `__init__`.
+    """
+
+    @abstractmethod
+    def monitor(self):
+        """
+        :return: dict with left, top, width and height of the captured area. May be called before `open`.
+        """
+        pass
+
+    def monitors(self):
+        """
+        :return: list of monitor dicts, one for every frame returned by `grab_all`
+        """
+        return [self.monitor()]
+
+    def open(self):
+        pass
+
+    @abstractmethod
+    def grab(self):
+        """
+        :return: RawFrame, its pixels are only valid until the next grab
+        """
+        pass
+
+    def grab_all(self):
+        """
+        :return: list of RawFrames, one per captured display
+        """
+        return [self.grab()]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MssSource(FrameSource):
+    """
+    Cross-platform screen capture with mss
+    """
+
+    def __init__(self,
+                 display=values.DEFAULT_DISPLAY,
+                 region=None,
+                 window=None):
+        self.display = display
+        self._area = CaptureArea(display, region, window)
+        self._sct = None
+
+    def monitor(self):
+        return self._area.monitor()
+
+    def open(self):
+        self._sct = mss.mss()
+        self._area.open()
+
+    def grab(self):
+        sct_img = self._sct.grab(self._area.follow())
+        return RawFrame(sct_img.raw, tuple(sct_img.size))
+
+    def close(self):
+        self._area.close()
+        if self._sct is not None:
+            self._sct.close()
+            self._sct = None
+
+
+class MultiMssSource(FrameSource):
+    """
+    Several displays grabbed one after another through a single mss instance. Only the displays are grabbed,
+    not the parts of the all-monitors rectangle that no display covers.
+    """
+
+    def __init__(self,
+                 displays):
+        self.displays = list(displays)
+        self._sct = None
+        self._mons = None
+
+    def monitor(self):
+        return self.monitors()[0]
+
+    def monitors(self):
+        with mss.mss() as sct:
+            return [_pick_monitor(sct.monitors, display) for display in self.displays]
+
+    def open(self):
+        self._sct = mss.mss()
+        self._mons = [_pick_monitor(self._sct.monitors, display) for display in self.displays]
+
+    def grab(self):
+        sct_img = self._sct.grab(self._mons[0])
+        return RawFrame(sct_img.raw, tuple(sct_img.size))
+
+    def grab_all(self):
+        frames = []
+        for mon in self._mons:
+            sct_img = self._sct.grab(mon)
+            frames.append(RawFrame(sct_img.raw, tuple(sct_img.size)))
+        return frames
+
+    def close(self):
+        if self._sct is not None:
+            self._sct.close()
+            self._sct = None
+
+
+# ---------------------------------------------------------------------------------
+# X11 shared memory
+
+_IPC_PRIVATE = 0
+_IPC_CREAT = 0o1000
+_IPC_RMID = 0
+_Z_PIXMAP = 2
+_ALL_PLANES = ctypes.c_ulong(-1)
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [("shmseg", ctypes.c_ulong),
+                ("shmid", ctypes.c_int),
+                ("shmaddr", ctypes.c_void_p),
+                ("readOnly", ctypes.c_int)]
+
+
+class _XImage(ctypes.Structure):
+    # Only the leading fields that are read here
+    _fields_ = [("width", ctypes.c_int),
+                ("height", ctypes.c_int),
+                ("xoffset", ctypes.c_int),
+                ("format", ctypes.c_int),
+                ("data", ctypes.c_void_p),
+                ("byte_order", ctypes.c_int),
+                ("bitmap_unit", ctypes.c_int),
+                ("bitmap_bit_order", ctypes.c_int),
+                ("bitmap_pad", ctypes.c_int),
+                ("depth", ctypes.c_int),
+                ("bytes_per_line", ctypes.c_int),
+                ("bits_per_pixel", ctypes.c_int)]
+
+
+def x11_available():
+    return sys.platform.startswith("linux") and bool(os.environ.get("DISPLAY")) and \
+        ctypes.util.find_library("X11") is not None
+
+
+def xshm_available():
+    return x11_available() and ctypes.util.find_library("Xext") is not None
+
+
+_X_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+
+
+class WindowTracker:
+    """
+    Finds an X11 window by its title and reports where it is on the screen. X errors (e.g. the window was
+    closed meanwhile) are ignored during the calls instead of ending the process.
+    """
+
+    def __init__(self,
+                 title):
+        self.title = title.lower()
+        self._x11 = None
+        self._dpy = None
+        self._root = None
+        self._window = None
+        self._handler = _X_ERROR_HANDLER(lambda dpy, event: 0)
+
+    def _load(self):
+        self._x11 = ctypes.cdll.LoadLibrary(ctypes.util.find_library("X11"))
+        self._x11.XOpenDisplay.restype = ctypes.c_void_p
+        self._x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self._x11.XDefaultRootWindow.restype = ctypes.c_ulong
+        self._x11.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        self._x11.XSetErrorHandler.restype = ctypes.c_void_p
+        self._x11.XSetErrorHandler.argtypes = [ctypes.c_void_p]
+        self._x11.XFetchName.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_char_p)]
+        self._x11.XFree.argtypes = [ctypes.c_void_p]
+        self._x11.XQueryTree.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong),
+                                         ctypes.POINTER(ctypes.c_ulong),
+                                         ctypes.POINTER(ctypes.POINTER(ctypes.c_ulong)),
+                                         ctypes.POINTER(ctypes.c_uint)]
+        self._x11.XGetGeometry.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong),
+                                           ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int),
+                                           ctypes.POINTER(ctypes.c_uint), ctypes.POINTER(ctypes.c_uint),
+                                           ctypes.POINTER(ctypes.c_uint), ctypes.POINTER(ctypes.c_uint)]
+        self._x11.XTranslateCoordinates.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_int,
+                                                    ctypes.c_int, ctypes.POINTER(ctypes.c_int),
+                                                    ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_ulong)]
+        self._x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+
+    def open(self):
+        self._load()
+        self._dpy = self._x11.XOpenDisplay(None)
+        if not self._dpy:
+            raise OSError("Can't open the X display")
+        self._root = self._x11.XDefaultRootWindow(self._dpy)
+
+    def _find(self, window):
+        """
+        :return: first window in the tree under `window` with the title, None if there is none
+        """
+        name = ctypes.c_char_p()
+        if self._x11.XFetchName(self._dpy, window, ctypes.byref(name)) and name.value is not None:
+            found = self.title in name.value.decode(errors="replace").lower()
+            self._x11.XFree(name)
+            if found:
+                return window
+
+        root, parent = ctypes.c_ulong(), ctypes.c_ulong()
+        children, n_children = ctypes.POINTER(ctypes.c_ulong)(), ctypes.c_uint()
+        if not self._x11.XQueryTree(self._dpy, window, ctypes.byref(root), ctypes.byref(parent),
+                                    ctypes.byref(children), ctypes.byref(n_children)):
+            return None
+        try:
+            for i in range(n_children.value):
+                found = self._find(children[i])
+                if found is not None:
+                    return found
+        finally:
+            if children:
+                self._x11.XFree(children)
+        return None
+
+    def geometry(self):
+        """
+        :return: (left, top, width, height) of the inside of the window on the screen, None if it's not open
+        """
+        previous = self._x11.XSetErrorHandler(ctypes.cast(self._handler, ctypes.c_void_p))
+        try:
+            if self._window is None:
+                self._window = self._find(self._root)
+                if self._window is None:
+                    return None
+            root, child = ctypes.c_ulong(), ctypes.c_ulong()
+            x, y = ctypes.c_int(), ctypes.c_int()
+            width, height, border, depth = ctypes.c_uint(), ctypes.c_uint(), ctypes.c_uint(), ctypes.c_uint()
+            if not self._x11.XGetGeometry(self._dpy, self._window, ctypes.byref(root), ctypes.byref(x),
+                                          ctypes.byref(y), ctypes.byref(width), ctypes.byref(height),
+                                          ctypes.byref(border), ctypes.byref(depth)) or \
+                    not self._x11.XTranslateCoordinates(self._dpy, self._window, self._root, 0, 0, ctypes.byref(x),
+                                                        ctypes.byref(y), ctypes.byref(child)):
+                self._window = None  # Closed, look it up again next time
+                return None
+            return x.value, y.value, width.value, height.value
+        finally:
+            self._x11.XSetErrorHandler(previous)
+
+    def close(self):
+        if self._dpy:
+            self._x11.XCloseDisplay(self._dpy)
+            self._dpy = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class XShmSource(FrameSource):
+    """
+    X11 capture with the MIT-SHM extension (Linux). The X server copies the screen straight into a shared
+    memory segment that is reused for every frame, so a frame is copied once less than with mss.
+    """
+
+    def __init__(self,
+                 display=values.DEFAULT_DISPLAY,
+                 region=None,
+                 window=None):
+        self.display = display
+        self._area = CaptureArea(display, region, window)
+        self._mon = None
+        self._x11 = None
+        self._xext = None
+        self._libc = None
+        self._dpy = None
+        self._image = None
+        self._shminfo = None
+        self._pixels = None
+
+    def monitor(self):
+        return self._area.monitor()
+
+    def _load(self):
+        self._x11 = ctypes.cdll.LoadLibrary(ctypes.util.find_library("X11"))
+        self._xext = ctypes.cdll.LoadLibrary(ctypes.util.find_library("Xext"))
+        self._libc = ctypes.CDLL(None, use_errno=True)
+
+        self._x11.XOpenDisplay.restype = ctypes.c_void_p
+        self._x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self._x11.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        self._x11.XDefaultVisual.restype = ctypes.c_void_p
+        self._x11.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self._x11.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self._x11.XDefaultRootWindow.restype = ctypes.c_ulong
+        self._x11.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        self._x11.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self._x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        self._xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        self._xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+        self._xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                               ctypes.c_char_p, ctypes.POINTER(_XShmSegmentInfo),
+                                               ctypes.c_uint, ctypes.c_uint]
+        self._xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        self._xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        self._xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage),
+                                            ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        self._libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        self._libc.shmat.restype = ctypes.c_void_p
+        self._libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        self._libc.shmdt.argtypes = [ctypes.c_void_p]
+        self._libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    def open(self):
+        self._mon = self._area.open()
+        self._load()
+        self._dpy = self._x11.XOpenDisplay(None)
+        if not self._dpy:
+            raise OSError("Can't open the X display")
+        if not self._xext.XShmQueryExtension(self._dpy):
+            self.close()
+            raise OSError("The X server doesn't support MIT-SHM")
+
+        screen = self._x11.XDefaultScreen(self._dpy)
+        width, height = self._mon['width'], self._mon['height']
+        self._shminfo = _XShmSegmentInfo()
+        self._image = self._xext.XShmCreateImage(self._dpy, self._x11.XDefaultVisual(self._dpy, screen),
+                                                 self._x11.XDefaultDepth(self._dpy, screen), _Z_PIXMAP, None,
+                                                 ctypes.byref(self._shminfo), width, height)
+        if not self._image:
+            self.close()
+            raise OSError("XShmCreateImage failed")
+        image = self._image.contents
+        if image.bits_per_pixel != 32 or image.bytes_per_line != width * 4:
+            self.close()
+            raise OSError(f"Unsupported X image layout ({image.bits_per_pixel} bpp)")
+
+        size = image.bytes_per_line * height
+        self._shminfo.shmid = self._libc.shmget(_IPC_PRIVATE, size, _IPC_CREAT | 0o600)
+        if self._shminfo.shmid < 0:
+            self.close()
+            raise OSError(ctypes.get_errno(), "shmget failed")
+        self._shminfo.shmaddr = self._libc.shmat(self._shminfo.shmid, None, 0)
+        image.data = self._shminfo.shmaddr
+        self._shminfo.readOnly = 0
+        self._xext.XShmAttach(self._dpy, ctypes.byref(self._shminfo))
+        self._x11.XSync(self._dpy, 0)
+        # Mark the segment for removal now, it stays alive until both sides detach - even after a crash
+        self._libc.shmctl(self._shminfo.shmid, _IPC_RMID, None)
+        self._pixels = memoryview((ctypes.c_char * size).from_address(self._shminfo.shmaddr)).cast("B")
+
+    def grab(self):
+        root = self._x11.XDefaultRootWindow(self._dpy)
+        mon = self._area.follow()
+        self._xext.XShmGetImage(self._dpy, root, self._image, mon['left'], mon['top'], _ALL_PLANES)
+        return RawFrame(self._pixels, (self._mon['width'], self._mon['height']), owned=False)
+
+    def close(self):
+        self._area.close()
+        if self._pixels is not None:
+            self._pixels.release()
+            self._pixels = None
+        if self._shminfo is not None and self._shminfo.shmaddr:
+            self._xext.XShmDetach(self._dpy, ctypes.byref(self._shminfo))
+            self._x11.XSync(self._dpy, 0)
+            self._libc.shmdt(self._shminfo.shmaddr)
+        self._shminfo = None
+        self._image = None  # XDestroyImage would free() the shared memory address
+        if self._dpy:
+            self._x11.XCloseDisplay(self._dpy)
+            self._dpy = None
+
+
+# ---------------------------------------------------------------------------------
+# Recorded raw frames
+
+_RAW_FILE_MAGIC = b"IRRAW001"
+_RAW_FILE_HEADER = struct.Struct("<8sII")  # magic, width, height
+_RAW_FRAME_HEADER = struct.Struct("<Q")  # nanoseconds since the first frame
+
+
+class RawFileWriter:
+    """
+    Records raw BGRA frames with their timing for ReplaySource
+    """
+
+    def __init__(self,
+                 path,
+                 size):
+        self.size = size
+        self._file = open(path, "wb")
+        self._file.write(_RAW_FILE_HEADER.pack(_RAW_FILE_MAGIC, *size))
+        self._start = None
+
+    def write(self, raw, timestamp):
+        """
+        :param raw: BGRA pixels of a frame of `size`
+        :param timestamp: perf_counter_ns capture time
+        """
+        if self._start is None:
+            self._start = timestamp
+        self._file.write(_RAW_FRAME_HEADER.pack(timestamp - self._start))
+        self._file.write(raw)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ReplaySource(FrameSource):
+    """
+    Plays back a file recorded with RawFileWriter with its original timing, looping at the end. Every grab
+    returns the frame that would be on the screen at that moment, so the content doesn't depend on the
+    recorder's pace - deterministic input for performance tests without a display.
+    """
+
+    def __init__(self,
+                 path,
+                 region=None):
+        """
+        :param region: (x, y, width, height) of the recorded frames to play back, None - whole frames
+        """
+        self.path = path
+        with open(path, "rb") as file:
+            magic, width, height = _RAW_FILE_HEADER.unpack(file.read(_RAW_FILE_HEADER.size))
+        if magic != _RAW_FILE_MAGIC:
+            raise ValueError(f"{path} is not a raw frame recording")
+        self.size = (width, height)
+        self._frame_size = width * height * 4
+        self._mon = {'left': 0, 'top': 0, 'width': width, 'height': height}
+        if region is not None:
+            self._mon = _bounded(self._mon, *region)
+        self._mmap = None
+        self._data = None
+        self._pixels = None  # Reused for every frame, like the screen grabbed by the other sources
+        self._times = []
+        self._start = None
+
+    def monitor(self):
+        return self._mon
+
+    def open(self):
+        with open(self.path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._data = memoryview(self._mmap)
+        self._pixels = bytearray(self._mon['width'] * self._mon['height'] * 4)
+        stride = _RAW_FRAME_HEADER.size + self._frame_size
+        n_frames = (len(self._mmap) - _RAW_FILE_HEADER.size) // stride
+        self._times = [_RAW_FRAME_HEADER.unpack_from(self._mmap, _RAW_FILE_HEADER.size + i * stride)[0]
+                       for i in range(n_frames)]
+        if not self._times:
+            raise ValueError(f"{self.path} has no frames")
+        self._start = None
+
+    def grab(self):
+        now = time.perf_counter_ns()
+        if self._start is None:
+            self._start = now
+        # Loop one frame interval after the last frame
+        length = self._times[-1] + (self._times[-1] // max(1, len(self._times) - 1))
+        elapsed = (now - self._start) % max(1, length)
+
+        # Newest frame due by now
+        i = max(0, bisect.bisect_right(self._times, elapsed) - 1)
+        start = _RAW_FILE_HEADER.size + i * (_RAW_FRAME_HEADER.size + self._frame_size) + _RAW_FRAME_HEADER.size
+        width, height = self._mon['width'], self._mon['height']
+        if (width, height) == self.size:
+            self._pixels[:] = self._data[start:start + self._frame_size]
+        else:
+            # Copy only the rows of the region, like a grab of a part of the screen
+            row = width * 4
+            start += (self._mon['top'] * self.size[0] + self._mon['left']) * 4
+            for y in range(height):
+                offset = start + y * self.size[0] * 4
+                self._pixels[y * row:(y + 1) * row] = self._data[offset:offset + row]
+        return RawFrame(self._pixels, (width, height), owned=False)
+
+    def close(self):
+        if self._data is not None:
+            self._data.release()
+            self._data = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+def make_source(name=values.DEFAULT_SOURCE, display=values.DEFAULT_DISPLAY, replay_file=None, displays=None,
+                region=None, window=None):
+    """
+    :param name: values.SOURCE_MSS, SOURCE_XSHM or SOURCE_REPLAY
+    :param displays: list of displays to capture at once, None - only `display`. Several displays are always
+                     grabbed with mss, whole.
+    :param region: (x, y, width, height) of the display to grab, None - the whole display
+    :param window: part of the title of an X11 window to follow instead of a fixed region, not for replays
+    :return: FrameSource, mss if the requested one isn't available on this system
+    """
+    if displays is not None and len(displays) > 1 and name != values.SOURCE_REPLAY:
+        return MultiMssSource(displays)
+    if name == values.SOURCE_XSHM and xshm_available():
+        return XShmSource(display, region, window)
+    if name == values.SOURCE_REPLAY and replay_file:
+        return ReplaySource(replay_file, region)
+    return MssSource(display, region, window)
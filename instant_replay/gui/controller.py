@@ -1,14 +1,15 @@
 import json
 from copy import copy
 
-import mss
 from PyQt5 import QtCore
-from PyQt5.QtCore import pyqtSlot, QObject
+from PyQt5.QtCore import pyqtSlot, pyqtSignal, QObject
 from infi.systray import SysTrayIcon
 from pynput.keyboard import GlobalHotKeys
 
 from instant_replay import values
-from instant_replay.capture.capture import Capture, VID_ENCODERS, P_ENCODERS, FileSaver
+from instant_replay.capture.capture import Capture, FfmpegVideoEncoder, FileSaver, P_ENCODERS, VID_ENCODERS, \
+    parse_resolution
+from instant_replay.capture.sources import n_of_displays, parse_region
 
 
 def save_config(config, file_name):
@@ -16,6 +17,11 @@ def save_config(config, file_name):
         json.dump(config, file, indent=4)
 
 
+# Settings applied without restarting the capture
+_LIVE_KEYS = set(values.LIVE_CONFIG) | {'codec', 'video_preset', 'p_ext', 'video_path', 'screen_path',
+                                        'video_hotkey', 'screen_hotkey'}
+
+
 def get_default_config():
     return values.DEFAULT_CONFIG
 
@@ -24,48 +30,69 @@ def get_config_options():
     return values.ALL_CONFIG_VALUES
 
 
-def n_of_displays():
-    with mss.mss() as sct:
-        displays = len(sct.monitors)
-    return displays - 1
+class ExportNotifier(QObject):
+    """
+    Export events arrive on a background thread - re-emit them as signals handled in the GUI thread
+    """
+    progress = pyqtSignal(int, int, int)  # job id, frames done, frames total
+    finished = pyqtSignal(int, str)  # job id, path
+    failed = pyqtSignal(int, str)  # job id, error
+    cancelled = pyqtSignal(int)  # job id
+    rejected = pyqtSignal()  # export queue was full
+    shot_saved = pyqtSignal(int, str, float)  # screenshot id, path, seconds from the request
+    shot_failed = pyqtSignal(int, str)  # screenshot id, error
+
+    def __call__(self, event, job_id, *args):
+        if event == values.EXPORT_PROGRESS:
+            self.progress.emit(job_id, *args)
+        elif event == values.EXPORT_DONE:
+            self.finished.emit(job_id, args[0])
+        elif event == values.EXPORT_FAILED:
+            self.failed.emit(job_id, args[0])
+        elif event == values.EXPORT_CANCELLED:
+            self.cancelled.emit(job_id)
+        elif event == values.SHOT_DONE:
+            self.shot_saved.emit(job_id, *args)
+        elif event == values.SHOT_FAILED:
+            self.shot_failed.emit(job_id, args[0])
 
 
 class Controller(QObject):
-    def __init__(self, view, verbose=False):
+    def __init__(self, view_factory, verbose=False):
+        """
+        :param view_factory: callable building the options window, it's called the first time the window is shown
+        """
         super(Controller, self).__init__()
         self.verbose = verbose
         self.closed = False
 
-        self.view = view
-        self.create_tray()
-        self.n_of_displays = n_of_displays()
-        self.config = self._load_config(values.CONFIG_FILE_NAME)
-        self._set_config_options()
-        self._show_config()
-
-
-        # self.view.option_button.clicked.connect(self.select_option_widget)
-        self.view.start_button.clicked.connect(self.start_capture)
-        self.view.capture_button.clicked.connect(self.export_replay)
-        self.view.screenshot_button.clicked.connect(self.export_screenshot)
-        self.view.stop_button.clicked.connect(self.stop_capture)
-        self.view.exit_button.clicked.connect(self.close_app)
-        self.view.reset_button.clicked.connect(self.show_default_config)
-        self.view.save_button.clicked.connect(self.update_config_from_gui)
-
+        self.view_factory = view_factory
+        self.view = None
         self.model: Capture = None
         self.hotkeys: GlobalHotKeys = None
+        self.config = self._load_config(values.CONFIG_FILE_NAME)
+
+        self.export_notifier = ExportNotifier()
+        self.export_notifier.progress.connect(self.show_export_progress)
+        self.export_notifier.finished.connect(self.show_export_finished)
+        self.export_notifier.failed.connect(self.show_export_failed)
+        self.export_notifier.rejected.connect(self.show_export_rejected)
+        self.export_notifier.shot_saved.connect(self.show_screenshot_saved)
+        self.export_notifier.shot_failed.connect(self.show_screenshot_failed)
 
         self._setup_services()
 
+        # Refresh the measured RAM usage while recording
+        self.ram_timer = QtCore.QTimer(self)
+        self.ram_timer.timeout.connect(self.show_ram_usage)
+        self.ram_timer.start(values.RAM_REFRESH_MS)
+
         if not self.config['tray']:
             self._show_gui()
 
         if self.config['start_capture']:
             self.model.start_recording()
 
-        self.view.show()
-
     def _make_hotkeys(self) -> GlobalHotKeys:
         """
         GlobalHotKeys object will use current hotkeys
@@ -112,24 +139,43 @@ class Controller(QObject):
 
         return SysTrayIcon(values.APP_ICON, values.APP_NAME, menu_options, on_quit=close_app)
 
+    def _build_view(self):
+        """
+        Create the options window and fill it with the current configuration
+        """
+        if self.verbose:
+            print("[Controller] Building the options window")
+        self.view = self.view_factory()
+        self._set_config_options()
+        self._show_config()
+
+        # self.view.option_button.clicked.connect(self.select_option_widget)
+        self.view.start_button.clicked.connect(self.start_capture)
+        self.view.capture_button.clicked.connect(self.export_replay)
+        self.view.screenshot_button.clicked.connect(self.export_screenshot)
+        self.view.stop_button.clicked.connect(self.stop_capture)
+        self.view.exit_button.clicked.connect(self.close_app)
+        self.view.reset_button.clicked.connect(self.show_default_config)
+        self.view.save_button.clicked.connect(self.update_config_from_gui)
+
     def _show_gui(self):
         """
-        Restore window view and put it in front
+        Restore window view and put it in front. The window is built the first time it's shown.
         """
+        if self.view is None:
+            self._build_view()
         self.view.show()
         self.view.setWindowState(self.view.windowState() & ~QtCore.Qt.WindowMinimized | QtCore.Qt.WindowActive)
         self.view.activateWindow()
 
-    def _make_model(self):
+    def _make_encoders(self):
         """
-        Get model with a correct video encoder (according to the extension used)
+        Video and photo encoders according to the extensions used
+        :return: (VideoEncoder, PhotoEncoder)
         """
-        try:
-            VID_ENCODERS[self.config['codec']]
-        except KeyError:
+        if self.config['codec'] not in VID_ENCODERS or not VID_ENCODERS[self.config['codec']].available():
             self.config['codec'] = 'mp4'
-        finally:
-            vid_encoder = VID_ENCODERS[self.config['codec']]
+        vid_encoder = VID_ENCODERS[self.config['codec']]
 
         try:
             P_ENCODERS[self.config['p_ext']]
@@ -140,14 +186,19 @@ class Controller(QObject):
 
         vid_path = self.config['video_path']
         vid_pref = "video"
-        vid_ext = self.config['codec']
+        vid_ext = vid_encoder.extension
         p_path = self.config['screen_path']
         p_pref = "screenshot"
         p_ext = self.config['p_ext']
+        vid_options = {'preset': self.config['video_preset']} if issubclass(vid_encoder, FfmpegVideoEncoder) else {}
+        return vid_encoder(self.config['fps'], FileSaver(vid_path, vid_pref, vid_ext), **vid_options), \
+            p_encoder(FileSaver(p_path, p_pref, p_ext))
+
+    def _make_model(self):
         return Capture.from_config(
             self.config,
-            vid_encoder(self.config['fps'], FileSaver(vid_path, vid_pref, vid_ext)),
-            p_encoder(FileSaver(p_path, p_pref, p_ext)),
+            *self._make_encoders(),
+            export_listener=self.export_notifier,
             verbose=self.verbose)
 
     def _load_config(self, file_name):
@@ -160,7 +211,7 @@ class Controller(QObject):
                         out_conf[key] = values.DEFAULT_CONFIG[key]
                     if key in all_config and out_conf[key] not in all_config[key]:
                         out_conf[key] = values.DEFAULT_CONFIG[key]
-                if out_conf['display'] > self.n_of_displays or out_conf['display'] <= 0:
+                if out_conf['display'] <= 0:  # Displays that are gone are replaced when capturing
                     out_conf['display'] = 1
 
         except IOError:  # if not found, create a new one
@@ -176,9 +227,14 @@ class Controller(QObject):
         options = get_config_options()
         self.view.resolution_combo_box.addItems([str(x) for x in options['resolution']])
         self.view.FPS_combo_box.addItems([str(x) for x in options['fps']])
-        self.view.extension_combo_box.addItems([str(x) for x in options['codec']])
+        # h264 and hevc come last, hidden together when ffmpeg is missing
+        self.view.extension_combo_box.addItems([str(x) for x in options['codec'] if VID_ENCODERS[x].available()])
         self.view.photo_extension_combo_box.addItems([str(x) for x in options['p_ext']])
-        self.view.display_combo_box.addItems([f"Display {str(x)}" for x in range(1, self.n_of_displays+1)])
+        displays = n_of_displays()
+        self.view.display_combo_box.addItems([f"Display {str(x)}" for x in range(1, displays + 1)])
+        if self.config['display'] > displays:
+            self.config['display'] = 1
+        self.config['displays'] = [display for display in self.config['displays'] if 1 <= display <= displays]
 
     def _setup_services(self):
         self.model = self._make_model()
@@ -212,35 +268,39 @@ class Controller(QObject):
         self.view.video_hotkey.setText(config['video_hotkey'])
         self.view.screen_hotkey.setText(config['screen_hotkey'])
         self.view.quality_slider.setValue(config['quality'])
+        on_disk = config['storage'] in (values.STORAGE_DISK, values.STORAGE_PERSISTENT)
+        self.view.duration_horizontal_slider.setMaximum(values.MAX_DISK_LEN if on_disk else values.MAX_LEN)
         self.view.duration_horizontal_slider.setValue(config['duration'])
         self.view.v_storage_line.setText(config['video_path'])
         self.view.s_storage_line.setText(config['screen_path'])
+        self.view.region_line.setText(config['region'])
+        self.view.window_line.setText(config['window'])
 
-        self.view.ram_display.display(self._get_ram_usage())
+        self.view.ram_display.display(self._get_ram_usage(config))
 
-    def _get_ram_usage(self):
+    def _get_ram_usage(self, config=None):
         """
-        Based on chosen settings, calculate the RAM usage.
+        RAM used by the buffered frames in MB, measured while recording. Otherwise the configured budget.
         """
-
-        default = self.config['resolution'].split('x')
-
-        return self.config['fps'] * int(self.config['duration']) * \
-            int(self.config['quality']) / 100 * int(default[0]) * int(default[1]) / 2073600 * 0.8
+        if config is None:
+            config = self.config
+        if self.model is not None and self.model.is_recording:
+            return round(self.model.get_buffer_usage()['used'] / values.MB)
+        return round(config['ram_usage'] / values.MB)
 
     def _stop_services(self):
         self.stop_capture()
         self.hotkeys.stop()
+        self.model.close()
 
     @pyqtSlot()
     def update_config_from_gui(self):
         """
         Save configuration present in view into a file.
-        Restart all services with new configuration.
-        If recording was running - resume it with the new settings
+        Apply the new configuration to the running services. Settings the capture processes can't change live
+        restart all services - if recording was running, it's resumed with the new settings.
         """
-        was_recording = self.model.is_recording
-        self._stop_services()
+        old_config = copy(self.config)
 
         # Get indexed values
         self.config['resolution'] = self.view.resolution_combo_box.currentText()
@@ -256,17 +316,36 @@ class Controller(QObject):
         self.config['duration'] = int(self.view.duration_horizontal_slider.value())
         self.config['video_path'] = self.view.v_storage_line.text()
         self.config['screen_path'] = self.view.s_storage_line.text()
+        self.config['region'] = self.view.region_line.text().strip()
+        if self.config['region'] and parse_region(self.config['region']) is None:
+            self.config['region'] = old_config['region']
+            self._show_status("Capture area must look like 1280x720+0+0", 5000)
+        self.config['window'] = self.view.window_line.text().strip()
 
         # Save config to file
         save_config(self.config, values.CONFIG_FILE_NAME)
 
-        # Restart all services with the new configuration
-        self._setup_services()
+        changed = {key for key in self.config if self.config[key] != old_config[key]}
+        if changed <= _LIVE_KEYS and self.model.reconfigure(fps=self.config['fps'],
+                                                             quality=self.config['quality'],
+                                                             resolution=parse_resolution(self.config['resolution']),
+                                                             display=self.config['display'],
+                                                             region=parse_region(self.config['region']),
+                                                             window=self.config['window'] or None):
+            self.model.video_encoder, self.model.photo_encoder = self._make_encoders()
+            if changed & {'video_hotkey', 'screen_hotkey'}:
+                self.hotkeys.stop()
+                self.hotkeys = self._make_hotkeys()
+                self.hotkeys.start()
+        else:
+            # Restart all services with the new configuration
+            was_recording = self.model.is_recording
+            self._stop_services()
+            self._setup_services()
+            if was_recording:
+                self.start_capture()
         self._show_config()
 
-        if was_recording:
-            self.start_capture()
-
     @pyqtSlot()
     def show_default_config(self):
         """
@@ -284,7 +363,12 @@ class Controller(QObject):
         if self.verbose:
             print("[Controller] Replay")
         if self.model:
-            self.model.export_recording()
+            if self.config['multi_export'] == values.EXPORT_COMPOSITE:
+                results = [self.model.export_recording(composite=True)]
+            else:
+                results = [self.model.export_recording(display) for display in self.model.displays]
+            if None in results:
+                self.export_notifier.rejected.emit()  # May be called from the hotkey thread
 
     @pyqtSlot()
     def export_screenshot(self):
@@ -293,10 +377,48 @@ class Controller(QObject):
         if self.model:
             self.model.export_screenshot()
 
+    def _show_status(self, message, timeout=0):
+        """
+        Show a message in the status bar of the options window, unless it was never opened
+        """
+        if self.view is not None:
+            self.view.statusBar().showMessage(message, timeout)
+
+    @pyqtSlot(int, int, int)
+    def show_export_progress(self, job_id, done, total):
+        self._show_status(f"Saving replay... {100 * done // max(total, 1)}%")
+
+    @pyqtSlot(int, str)
+    def show_export_finished(self, job_id, path):
+        self._show_status(f"Replay saved to {path}", 5000)
+
+    @pyqtSlot(int, str)
+    def show_export_failed(self, job_id, error):
+        self._show_status(f"Saving replay failed: {error}", 5000)
+
+    @pyqtSlot()
+    def show_export_rejected(self):
+        self._show_status("Too many replays are being saved, try again later", 5000)
+
+    @pyqtSlot(int, str, float)
+    def show_screenshot_saved(self, shot_id, path, latency):
+        self._show_status(f"Screenshot saved to {path} ({latency * 1000:.0f} ms)", 5000)
+
+    @pyqtSlot(int, str)
+    def show_screenshot_failed(self, shot_id, error):
+        self._show_status(f"Saving screenshot failed: {error}", 5000)
+
+    @pyqtSlot()
+    def show_ram_usage(self):
+        if self.view is not None and self.model is not None and self.model.is_recording:
+            self.view.ram_display.display(self._get_ram_usage())
+
     @pyqtSlot()
     def stop_capture(self):
         if self.model:
             self.model.stop_recording()
+            if self.view is not None:
+                self.view.ram_display.display(self._get_ram_usage())
 
     @pyqtSlot()
     def close_app(self):
@@ -306,6 +428,8 @@ class Controller(QObject):
         if self.verbose:
             print("[Controller] Closing the app...")
         self._stop_services()
-        self.view.should_close = True
-        self.view.close()
+        if self.view is not None:
+            self.view.should_close = True
+            self.view.close()
+        QtCore.QCoreApplication.quit()
         self.closed = True
@@ -159,6 +159,14 @@ class UiMainWindow(QMainWindow):
 
         self.ram_display = self.make_lcd_display("ram_display", (480, 100), 210, 42)
 
+        self.region_label = self.make_label("region_label", self.option)
+        self.region_label.setGeometry(QtCore.QRect(480, 160, 201, 32))
+        self.region_line = self.make_storage_line("region_line", (480, 195))
+
+        self.window_label = self.make_label("window_label", self.option)
+        self.window_label.setGeometry(QtCore.QRect(480, 235, 201, 32))
+        self.window_line = self.make_storage_line("window_line", (480, 270))
+
         self.main_stacked_widget.addWidget(self.option)
 
         self.video = QtWidgets.QWidget()
@@ -376,7 +384,11 @@ class UiMainWindow(QMainWindow):
         self.s_storage_browse.setText(_translate(values.APP_NAME, "Browse"))
         self.reset_button.setText(_translate(values.APP_NAME, "Reset"))
         self.save_button.setText(_translate(values.APP_NAME, "Save"))
-        self.ram_label.setText(_translate(values.APP_NAME, "RAM requirements (MB)"))
+        self.ram_label.setText(_translate(values.APP_NAME, "RAM usage (MB)"))
+        self.region_label.setText(_translate(values.APP_NAME, "Capture area (WxH+X+Y)"))
+        self.region_line.setPlaceholderText(_translate(values.APP_NAME, "Whole display"))
+        self.window_label.setText(_translate(values.APP_NAME, "Follow window"))
+        self.window_line.setPlaceholderText(_translate(values.APP_NAME, "Window title"))
 
     # ---------------------------------------------------------------------------------
     # Override events
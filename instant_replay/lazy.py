@@ -0,0 +1,22 @@
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """
+    Import a module on first attribute access instead of now. Heavy libraries (cv2, PIL) are only needed once
+    something is encoded, so importing them eagerly would slow down every app start.
+    :param name: absolute module name, e.g. "PIL.Image"
+    :return: the module, loaded when first used
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
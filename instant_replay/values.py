@@ -7,7 +7,10 @@ CONFIG_FILE_NAME = os.path.join(ROOT_DIR, "config.json")
 CAPTURE_JPEG = "JPEG"
 CAPTURE_PNG = "PNG"
 
+MB = 1024 * 1024
+
 MAX_LEN = 45
+MAX_DISK_LEN = 600  # Replays kept on disk can be much longer
 
 DEFAULT_START_CAP = False
 DEFAULT_RESOLUTION = '1920x1080'
@@ -22,8 +25,24 @@ DEFAULT_QUALITY = 80  # Range 0-95
 DEFAULT_DURATION = 20  # Based on RAM
 DEFAULT_V_PATH = "videos"
 DEFAULT_P_PATH = "photos"
-DEFAULT_RAM_USAGE = 500 * 1024 * 1024  # 500 * MB
+DEFAULT_RAM_USAGE = 500 * MB
 DEFAULT_RUN_TRAY = True
+DEFAULT_TRANSPORT = "shm"  # Raw frames in shared memory slots, "queue" pickles whole screenshots instead
+DEFAULT_ENCODERS = 0  # Frame encoding processes, 0 - based on the measured encoding time
+# "delta" stores only the changed parts of mostly static screens, "segments" encodes the video continuously
+# (needs ffmpeg), so an export only joins the newest segments
+DEFAULT_BUFFER_MODE = "full"
+DEFAULT_STORAGE = "ram"  # "disk" keeps the encoded frames in a memory-mapped file, "persistent" also across restarts
+DEFAULT_DISK_USAGE = 4 * 1024 * MB
+DEFAULT_BUFFER_FILE = os.path.join(ROOT_DIR, "replay_buffer.bin")
+DEFAULT_SOURCE = "mss"  # "xshm" - faster X11 capture on Linux, "replay" - play back a raw frame recording
+DEFAULT_REPLAY_FILE = ""
+DEFAULT_METRICS_PORT = 0  # Serve pipeline metrics on http://127.0.0.1:<port>/metrics, 0 - disabled
+DEFAULT_DISPLAYS = []  # Displays recorded together with 'display', each into its own buffer
+DEFAULT_VIDEO_PRESET = "fast"  # "small" - slower h264/hevc exports with smaller files
+DEFAULT_REGION = ""  # "WIDTHxHEIGHT+X+Y" part of the display to record, empty - the whole display
+DEFAULT_WINDOW = ""  # Part of the title of an X11 window to follow, empty - don't follow any window
+DEFAULT_MULTI_EXPORT = "each"  # "composite" - one video with all recorded displays arranged like on the desktop
 
 DEFAULT_CONFIG = {
                   'start_capture': DEFAULT_START_CAP,
@@ -40,23 +59,116 @@ DEFAULT_CONFIG = {
                   'video_path': DEFAULT_V_PATH,
                   'screen_path': DEFAULT_P_PATH,
                   'ram_usage': DEFAULT_RAM_USAGE,
-                  'tray': True
+                  'tray': True,
+                  'transport': DEFAULT_TRANSPORT,
+                  'encoders': DEFAULT_ENCODERS,
+                  'buffer_mode': DEFAULT_BUFFER_MODE,
+                  'storage': DEFAULT_STORAGE,
+                  'disk_usage': DEFAULT_DISK_USAGE,
+                  'buffer_file': DEFAULT_BUFFER_FILE,
+                  'source': DEFAULT_SOURCE,
+                  'replay_file': DEFAULT_REPLAY_FILE,
+                  'metrics_port': DEFAULT_METRICS_PORT,
+                  'displays': DEFAULT_DISPLAYS,
+                  'multi_export': DEFAULT_MULTI_EXPORT,
+                  'video_preset': DEFAULT_VIDEO_PRESET,
+                  'region': DEFAULT_REGION,
+                  'window': DEFAULT_WINDOW
 }
 
 
 ALL_CONFIG_VALUES = {
-                'resolution': ['1920x1080'],
+                'resolution': ['native', '3840x2160', '2560x1440', '1920x1080', '1600x900', '1280x720', '960x540'],
                 'fps': [10, 15, 20, 25, 30],
-                'codec': ['mp4'],
-                'p_ext': ["png", "jpeg"]
+                'codec': ['mp4', 'avi', 'h264', 'hevc'],
+                'p_ext': ["png", "jpeg"],
+                'transport': ["shm", "queue"],
+                'buffer_mode': ["full", "delta", "segments"],
+                'storage': ["ram", "disk", "persistent"],
+                'source': ["mss", "xshm", "replay"],
+                'multi_export': ["each", "composite"],
+                'video_preset': ["fast", "small"]
 }
 
 
 DEFAULT_SCREEN_SIZE = (1920, 1080)
 
+TRANSPORT_SHM = "shm"
+TRANSPORT_QUEUE = "queue"
+PACER_SPIN_NS = 500_000  # Busy-wait only for the last 0.5 ms before a frame is due
+PACER_HISTORY = 300  # Frames kept for the fps and jitter statistics
+ENCODER_PROBE_FRAMES = 10  # Frames encoded in-process before picking the number of encoders
+ENCODER_HEADROOM = 1.25  # Spare encoding capacity, so the encoders keep up with occasional slow frames
+MAX_ENCODERS = 4
+EXPORT_QUEUE_SIZE = 4  # Exports waiting for the exporting process, more are rejected
+MAX_SNAPSHOTS = EXPORT_QUEUE_SIZE + 2  # Exports queued or running, each pins its frames in the buffer
+BUFFER_HEADROOM = 2  # Index and data room for a whole replay recorded while an older one is pinned by an export
+EXPORT_PROGRESS_EVERY = 10  # Frames between progress events
+EXPORT_PREFETCH = 4  # Frames decoded ahead of the video writer during export
+EXPORT_MAX_GAP = 2  # Seconds, longer gaps between frames are not filled with repeated frames on export
+COMPOSITE_QUALITY = 95  # JPEG quality of the frames put together from several displays on export
+FFMPEG_BINARY = "ffmpeg"  # Used by the h264 and hevc video encoders, looked up on PATH
+FFMPEG_THREADS = 0  # Encoding threads, 0 - one per core
+FFMPEG_PRESETS = {
+    'libx264': {'fast': ["-preset", "ultrafast", "-tune", "zerolatency", "-crf", "23"],
+                'small': ["-preset", "slow", "-crf", "23"]},
+    'libx265': {'fast': ["-preset", "ultrafast", "-tune", "zerolatency", "-crf", "28", "-tag:v", "hvc1"],
+                'small': ["-preset", "slow", "-crf", "28", "-tag:v", "hvc1"]},
+}
+SEGMENT_SECONDS = 2  # Length of the continuously encoded segments, exports are rounded up to whole segments
+SEGMENT_SPARE = 3  # Segments kept beyond the replay length
+SEGMENT_EXTENSION = "mp4"  # Replays joined from segments are always written as MP4
+SEGMENT_PRESET = ["-preset", "ultrafast", "-tune", "zerolatency"]  # Encoding runs while recording, keep it cheap
+SEGMENT_CRF_BEST = 18  # x264 constant rate factor at quality 95
+SEGMENT_CRF_WORST = 40  # and at quality 0
+WINDOW_POLL = 0.25  # Seconds, how often a followed window is checked for moves
+SHOT_MAX_AGE = 2  # Frame intervals, screenshots reuse the newest recorded frame if it isn't older
+FILE_MAX_GAPS = 1000  # Free file numbers between the used ones remembered per output directory
+SOURCE_MSS = "mss"
+SOURCE_XSHM = "xshm"
+SOURCE_REPLAY = "replay"
+STORAGE_RAM = "ram"
+STORAGE_DISK = "disk"
+STORAGE_PERSISTENT = "persistent"
+INDEX_FILE_SUFFIX = ".idx"  # Header and index of a persistent buffer, next to its data file
+BUFFER_FULL = "full"
+BUFFER_DELTA = "delta"
+BUFFER_SEGMENTS = "segments"
+DELTA_TILE = 64  # Pixels, multiple of 16 so JPEG blocks don't cross tiles
+DELTA_MAX_CHANGED = 0.5  # Above this fraction of changed tiles a keyframe is stored instead
+DELTA_KEYFRAME_INTERVAL = 2  # Seconds
+
+FRAME_KEY = 0  # Complete frame
+FRAME_DELTA = 1  # Changed tiles only
+FRAME_REPEAT = 2  # Same as the previous frame, no data
+
+BUDGET_HIGH = 0.9  # Lower the quality when a whole replay is projected to fill more of its budget than this
+BUDGET_LOW = 0.6  # Raise it back when it would fill less than this
+BUDGET_QUALITY_STEP = 10
+MIN_QUALITY = 30  # Below this the frame rate is lowered instead
+MAX_FRAME_STEP = 4  # Store at least every 4th frame, the skipped ones repeat the previous frame
+
+RAM_REFRESH_MS = 1000  # Measured RAM usage shown in the GUI is refreshed this often
+
+RAW_SLOTS = 4  # Raw frames in flight between recorder and converter (plus one per encoder), more are dropped
+
 TASK_KILL = "KILL"
-TASK_TRIM = "TRIM"
-TASK_SHOT = "SHOT"
+TASK_PAUSE = "PAUSE"
+TASK_RESUME = "RESUME"
+TASK_CONFIG = "CONFIG"
+TASK_POLL = 0.5  # Seconds between checks that a converter is still alive while waiting for its answer
+TASK_TIMEOUT = 5  # Seconds a process gets to take a task or to finish, then it's given up on
+# Settings applied to the running capture processes
+LIVE_CONFIG = ('fps', 'quality', 'resolution', 'display', 'region', 'window')
+
+EXPORT_PROGRESS = "PROGRESS"
+EXPORT_DONE = "DONE"
+EXPORT_FAILED = "FAILED"
+EXPORT_CANCELLED = "CANCELLED"
+EXPORT_EACH = "each"
+EXPORT_COMPOSITE = "composite"
+SHOT_DONE = "SHOT_DONE"
+SHOT_FAILED = "SHOT_FAILED"
 
 APP_ICON = os.path.join(ROOT_DIR, "icons/application_icon.png")
 CAPTURE_ICON = os.path.join(ROOT_DIR, "icons/capture_icon.png")